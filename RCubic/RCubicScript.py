@@ -22,69 +22,168 @@
 # THE SOFTWARE.
 
 import os
+import io
 import logging
 import re
 import fnmatch
+import bisect
 import subprocess
 
+import gevent
+try:
+    from gevent import threadpool as gthreadpool
+except ImportError:
+    gthreadpool = None
+import simplejson
+from lxml import etree as et
+
 from RCubic import exectree
-from RCubic.RCubicUtilities import ConfigurationError
+from RCubic.RCubicUtilities import ConfigurationError, JSONCache, popenNonblock
 
 
 class RCubicScript(object):
-    def __init__(self, filepath, version, override, phase, logdir, whitelist, blacklist, regexval, group):
+    # Header fields are "#FIELD: value" comment lines at the top of the script
+    HEADER = re.compile(r"^#([A-Z0-9]+):\s*(.*)$")
+    SEPARATOR = re.compile(r"[,;\s]+")
+
+    def __init__(self, filepath, version, override, phase, logdir, whitelist, blacklist, regexval, group,
+                 header=None):
         self.path = filepath
         self.name = filepath.split("/")[-1]
         self.version = version
         self.override = override
         self.logfile = "{0}/{1}.log".format(logdir, self.name)
 
-        with open(self.path) as fd:
-            script = fd.read()
-        self.hdep = self._param_split(self._get_param(script, "HDEP"))
-        self.sdep = self._param_split(self._get_param(script, "SDEP"))
-        self.cdep = self._param_split(self._get_param(script, "CDEP"))
-        self.idep = self._get_param(script, "IDEP", None)
-        self.iterator = self._param_split(self._get_param(script, "ITER"))
-        self.resources = self._param_split(self._get_param(script, "RESOURCES"))
-        self.resources.append("default")
-        self.products = self._param_split(self._get_param(script, "PRODUCT"))
-        sphase = self._param_split(self._get_param(script, "PHASE"))
+        if header is None:
+            header = self._read_header(self.path)
+        self.hdep = self._param_split(header.get("HDEP"))
+        self.sdep = self._param_split(header.get("SDEP"))
+        self.cdep = self._param_split(header.get("CDEP"))
+        self.idep = header.get("IDEP", None)
+        self.iterator = self._param_split(header.get("ITER"))
+        self.iterstream = self._param_split(header.get("ITERSTREAM"))
+        self.iterfile = header.get("ITERFILE", "")
+        iterparallel = self._param_split(header.get("ITERPARALLEL"))
+        self.resources = self._resource_split(header.get("RESOURCES"))
+        if "default" not in [name for name, units in self.resources]:
+            self.resources.append(("default", 1))
+        self.products = self._param_split(header.get("PRODUCT"))
+        sphase = self._param_split(header.get("PHASE"))
         self.group = group
-        if regexval is None:
-            self.regexval = True
-        else:
-            r = regexval.search(script)
-            self.regexval = r is not None
+        # The scriptregex check reads the whole script, only done if asked
+        self._regex = regexval
+        self._source = filepath
+        self._regexval = None
         self.href = ""
 
         if len(sphase) >= 1:
             phase = RCubicScriptParser.PHASES[sphase[0]]
         self.phase = phase
 
+        try:
+            self.iterparallel = int(iterparallel[0]) if iterparallel else 1
+        except ValueError:
+            raise ConfigurationError(
+                "ITERPARALLEL of {0} is not an int.".format(self.path)
+            )
+
         if len(blacklist) > 0 and self.name in blacklist:
             self.path = "-"
         elif len(whitelist) > 0 and self.name not in whitelist:
             self.path = "-"
 
-    def _get_param(self, script, field, default=None):
-        fieldre = re.compile(r"^[\s]*#%s:.*$" % (field), re.MULTILINE)
-        begin = re.compile(r"^#[A-Z0-9]+:[\s]*")
-        line = fieldre.search(script)
-        return begin.sub("", line.group(0), 1) if line else default
+    @property
+    def regexval(self):
+        """True if the script matches scriptregex or none is configured"""
+        if self._regexval is None:
+            if self._regex is None:
+                self._regexval = True
+            else:
+                with open(self._source) as fd:
+                    self._regexval = self._regex.search(fd.read()) is not None
+        return self._regexval
+
+    def is_iterated(self):
+        return bool(self.iterator or self.iterstream or self.iterfile)
+
+    def snapshot(self):
+        """Return dict of the parsed script, see from_snapshot()"""
+        data = dict(
+            (k, v) for k, v in vars(self).items()
+            if k not in ("group", "job") and not k.startswith("_")
+        )
+        data["regexval"] = self.regexval
+        data["source"] = self._source
+        data["stamp"] = self.stamp(self._source)
+        return data
+
+    @staticmethod
+    def stamp(path):
+        """Return [size, mtime] of the file at path, None if it is missing"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime]
+
+    @classmethod
+    def from_snapshot(cls, data, group):
+        """Rebuild script of group from snapshot() without reading the file"""
+        rs = cls.__new__(cls)
+        rs.__dict__.update(data)
+        rs._regexval = rs.__dict__.pop("regexval")
+        rs._regex = None
+        rs._source = rs.__dict__.pop("source")
+        rs.__dict__.pop("stamp")
+        rs.resources = [tuple(resource) for resource in rs.resources]
+        rs.group = group
+        return rs
+
+    @classmethod
+    def _read_header(cls, path):
+        """Return {field: value} of the header, reading the script only up
+        to the first line that is neither a comment nor blank. The first
+        occurrence of a field wins."""
+        header = {}
+        with open(path) as fd:
+            for line in fd:
+                line = line.strip()
+                if not line:
+                    continue
+                if not line.startswith("#"):
+                    break
+                match = cls.HEADER.match(line)
+                if match is not None:
+                    header.setdefault(match.group(1), match.group(2))
+        return header
 
     def _param_split(self, param):
-        # Warning: code change not covered in tests
         # Split output by delimiters, eliminate empty strings
-        separator = re.compile(r"[,;\s]+")
-        return filter(None, separator.split(param)) if param else []
+        return filter(None, self.SEPARATOR.split(param)) if param else []
+
+    def _resource_split(self, param):
+        # Resources are listed as name or name=units, return [(name, units)]
+        resources = []
+        param = re.sub(r"\s*=\s*", "=", param) if param else param
+        for item in self._param_split(param):
+            name, sep, units = item.partition("=")
+            try:
+                units = int(units) if sep else 1
+            except ValueError:
+                units = 0
+            if units < 1:
+                raise ConfigurationError(
+                    "Units of resource {0} of {1} must be a positive int."
+                    .format(name, self.path)
+                )
+            resources.append((name, units))
+        return resources
 
     def _parseHeaderLine(self, line):
         # Warning: code change not covered in tests
         # Split output by delimiters, eliminate empty strings
-        begin = re.compile(r"^#[A-Z0-9]+:[\s]*")
-        separator = re.compile(r"[,;\s]+")
-        return filter(None, separator.split(begin.sub("", line, 1)))
+        match = self.HEADER.match(line.strip())
+        return self._param_split(match.group(2) if match else line)
 
 
 class RCubicGroup(object):
@@ -120,6 +219,14 @@ class RCubicGroup(object):
 
         self.autoselect = booler(element, "autoSelect", "true")
         self.fulloverride = booler(element, "fullOverride", "false")
+
+        try:
+            self.maxparallel = int(element.attrib.get("maxParallel", 0))
+        except ValueError:
+            raise ConfigurationError(
+                "Attribute maxParallel is not an int on line {0} of {1}."
+                .format(element.sourceline, element.base)
+            )
         self.forceselect = False
         self.scripts = []
 
@@ -144,8 +251,11 @@ class RCubicGroup(object):
 
 class RCubicScriptParser(object):
     PHASES = {"DEFAULT": 0, "EARLY": -1, "LATE": 1}
+    # Threads listing directories and reading script headers
+    SCAN_THREADS = 8
 
-    def __init__(self, groups, logdir, workdir, whitelist, blacklist, regexval, resources):
+    def __init__(self, groups, logdir, workdir, whitelist, blacklist, regexval, resources, maxparallel=0,
+                 githead=None, itercache=None, headercache=None):
         self.groups = groups
         self.logdir = logdir
         self.workdir = workdir
@@ -156,15 +266,25 @@ class RCubicScriptParser(object):
         self.whitelist = whitelist or []
         self.regexval = re.compile(regexval, re.MULTILINE) if regexval else None
         self.resources = resources
+        self.maxparallel = maxparallel
+        # Iterator command output cached by command, workdir, githead and
+        # the size and mtime of the script
+        self.githead = githead
+        self.itercache = itercache
+        # Script headers cached by (path, size, mtime)
+        self.headercache = headercache
         self.unusedresources = []
         self.tree = None
         self.subtrees = {}
+        # Dependency patterns expanded by _glob_expand, see _index_scripts
+        self._glob_memo = None
 
     def scripts(self):
         return [script for group in self.groups for script in group.scripts]
 
     def read_dirs(self, directory, override=False):
         failed_groups = []
+        groups = []
         for group in self.groups:
             groupdir = "{0}/{1}".format(directory, group)
             logging.debug("processing group {0} {1} {2}.".format(group.name, groupdir, override))
@@ -177,57 +297,175 @@ class RCubicScriptParser(object):
             else:
                 if not os.path.exists(groupdir):
                     continue
-            for filename in os.listdir(groupdir):
-                filepath = "{0}/{1}".format(groupdir, filename)
-                if filename.startswith("{0}_".format(group)):
-                    rs = RCubicScript(
-                        filepath,
-                        group.version,
-                        override,
-                        group.phase,
-                        self.logdir,
-                        self.whitelist,
-                        self.blacklist,
-                        self.regexval,
-                        group,
-                    )
-                    group.add_script(rs, override)
-                else:
-                    logging.debug(
-                        "Skipping {0}/{1}, does not start with {1}_."
-                        .format(filepath, group)
+            groups.append(group)
+
+        # Without gevent thread pools directories are scanned one at a time
+        pool = None
+        scan = map
+        if gthreadpool is not None:
+            pool = gthreadpool.ThreadPool(self.SCAN_THREADS)
+            scan = pool.map
+        try:
+            listings = scan(os.listdir, ["{0}/{1}".format(directory, group) for group in groups])
+            scripts = []
+            for group, filenames in zip(groups, listings):
+                for filename in filenames:
+                    filepath = "{0}/{1}/{2}".format(directory, group, filename)
+                    if filename.startswith("{0}_".format(group)):
+                        scripts.append((group, filepath))
+                    else:
+                        logging.debug(
+                            "Skipping {0}, does not start with {1}_."
+                            .format(filepath, group)
+                        )
+            headers = self._read_headers([filepath for group, filepath in scripts], scan)
+        finally:
+            if pool is not None:
+                pool.kill()
+
+        for (group, filepath), header in zip(scripts, headers):
+            rs = RCubicScript(
+                filepath,
+                group.version,
+                override,
+                group.phase,
+                self.logdir,
+                self.whitelist,
+                self.blacklist,
+                self.regexval,
+                group,
+                header,
+            )
+            group.add_script(rs, override)
+
+    def _read_headers(self, paths, scan=map):
+        """Return headers of the scripts at paths, read with scan (a map
+        function) unless cached"""
+        keys = [None] * len(paths)
+        headers = [None] * len(paths)
+        if self.headercache is not None:
+            for i, stat in enumerate(scan(os.stat, paths)):
+                keys[i] = JSONCache.key(paths[i], stat.st_size, stat.st_mtime)
+                header = self.headercache.get(keys[i])
+                if header is not None:
+                    # The rest of the parser works with str, not unicode
+                    header = dict(
+                        (str(field), value.encode("utf-8"))
+                        for field, value in header.iteritems()
                     )
+                headers[i] = header
+        missing = [i for i, header in enumerate(headers) if header is None]
+        read = scan(RCubicScript._read_header, [paths[i] for i in missing])
+        for i, header in zip(missing, read):
+            headers[i] = header
+            if self.headercache is not None:
+                self.headercache.set(keys[i], header)
+        if self.headercache is not None and paths:
+            logging.info(
+                "Header cache: {0} hits, {1} misses."
+                .format(self.headercache.hits, self.headercache.misses)
+            )
+            self.headercache.save(prune=True)
+        return headers
+
+    def _index_scripts(self):
+        """Index script names for _glob_expand and forget expanded patterns,
+        needed whenever scripts are added"""
+        scripts = self.scripts()
+        self._script_order = {}
+        for i, script in enumerate(scripts):
+            self._script_order.setdefault(script.name, i)
+        self._script_names = sorted(self._script_order)
+        self._glob_memo = {}
+
+    def _glob_match(self, dep):
+        """Return names of scripts matching pattern dep in script order"""
+        wild = exectree.ExecTree.GLOB_CHARS.search(dep)
+        if wild is None:
+            return [dep]
+        # Only names sharing the literal prefix of the pattern can match
+        prefix = dep[:wild.start()]
+        pattern = re.compile(fnmatch.translate(dep))
+        names = self._script_names
+        matches = []
+        for i in xrange(bisect.bisect_left(names, prefix), len(names)):
+            if not names[i].startswith(prefix):
+                break
+            if pattern.match(names[i]):
+                matches.append(names[i])
+        matches.sort(key=self._script_order.get)
+        return matches or [dep]
 
     def _glob_expand(self, deps):
+        # we return script names instead of job instances to let ExecTree
+        # handle dangling deps
+        if self._glob_memo is None:
+            self._index_scripts()
         rval = []
         for dep in deps:
-            matched = False
-            for script in self.scripts():
-                if fnmatch.fnmatchcase(script.name, dep):
-                    # we return script names instead of job instances to let
-                    # ExecTree handle dangling deps
-                    rval.append(script.name)
-                    matched = True
-            if not matched:
-                rval.append(dep)
+            matches = self._glob_memo.get(dep)
+            if matches is None:
+                matches = self._glob_memo[dep] = self._glob_match(dep)
+            rval.extend(matches)
         return rval
 
     def eval_args(self, script):
         logging.debug("iterator: {0}, cwd: {1}".format(script.iterator, self.workdir))
+        # Edits of the script count even without a git head
+        key = JSONCache.key(
+            script.iterator, self.workdir, self.githead, RCubicScript.stamp(script._source)
+        )
+        if self.itercache is not None:
+            args = self.itercache.get(key)
+            if args is not None:
+                args = [arg.encode("utf-8") for arg in args]
+                logging.debug("Cached arguments {0}".format(args))
+                return args
+
         with open("/dev/null", "w") as devnull:
-            if hasattr(subprocess, "check_output"):
-                output = subprocess.check_output(script.iterator, stderr=devnull, cwd=self.workdir)
-            else:
-                p = subprocess.Popen(script.iterator, stdout=subprocess.PIPE, stderr=devnull, cwd=self.workdir)
-                output = p.communicate()[0]
+            rcode, output = popenNonblock(script.iterator, stderr=devnull, cwd=self.workdir)
+        if rcode != 0:
+            raise subprocess.CalledProcessError(rcode, script.iterator)
 
         # Split output by delimiters, eliminate empty strings
-        separator = re.compile(r"[,;\s]+")
-        args = filter(None, separator.split(output))
+        args = filter(None, RCubicScript.SEPARATOR.split(output))
 
         logging.debug("Arguments {0}".format(args))
+        if self.itercache is not None:
+            self.itercache.set(key, args)
         return args
 
+    def eval_all_args(self, scripts):
+        """Run iterator commands of scripts at the same time, return {script name: args}"""
+        workers = dict((script.name, gevent.spawn(self.eval_args, script)) for script in scripts)
+        gevent.joinall(workers.values(), raise_error=True)
+        if self.itercache is not None:
+            logging.info(
+                "Iterator cache: {0} hits, {1} misses."
+                .format(self.itercache.hits, self.itercache.misses)
+            )
+            self.itercache.save()
+        return dict((name, worker.value) for name, worker in workers.items())
+
+    def make_iterator(self, script, args=None):
+        name = "{0}_iter".format(script.name)
+        if script.iterfile:
+            return exectree.ExecStreamIter(
+                name,
+                path=os.path.join(self.workdir, script.iterfile),
+                parallel=script.iterparallel
+            )
+        if script.iterstream:
+            return exectree.ExecStreamIter(
+                name,
+                command=script.iterstream,
+                cwd=self.workdir,
+                parallel=script.iterparallel
+            )
+        if args is None:
+            args = self.eval_args(script)
+        return exectree.ExecIter(name, args, script.iterparallel)
+
     def set_href(self, gerrit, project, githash, repopath):
         logging.debug("set hrefs")
         for script in self.scripts():
@@ -235,29 +473,146 @@ class RCubicScriptParser(object):
                 gerrit, project, script.path[len(repopath) + 1:], githash
             )
 
+    def _group_limits(self):
+        """Per group caps on parallel job processes"""
+        return dict(
+            (group.name, exectree.ExecLimit(group.maxparallel))
+            for group in self.groups
+            if group.maxparallel > 0
+        )
+
+    def save_snapshot(self, path, key):
+        """Write the scripts and the tree built by init_tree() to path, to be
+        loaded by load_snapshot() with the same key"""
+        scripts = []
+        for script in self.scripts():
+            data = script.snapshot()
+            data["group"] = script.group.name
+            data["job"] = script.job.uuidhex
+            scripts.append(data)
+        tree = io.BytesIO()
+        self.tree.write(tree)
+        snapshot = {
+            "key": key,
+            "tree": tree.getvalue(),
+            "scripts": scripts,
+        }
+        tmp = "{0}.tmp".format(path)
+        try:
+            with open(tmp, "w") as fd:
+                simplejson.dump(snapshot, fd)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            logging.warning("Failed to save tree snapshot {0}.".format(path))
+
+    def load_snapshot(self, path, key):
+        """Rebuild scripts and tree from a snapshot saved with the same key
+        instead of reading the script directories. Return the tree, or None
+        if there is no usable snapshot.
+
+        The snapshot is stale if a script changed size or mtime since it
+        was saved. Iterator commands are evaluated again, their output can
+        change between runs of the same commit.
+        """
+        try:
+            with open(path) as fd:
+                snapshot = simplejson.load(fd)
+        except (IOError, ValueError):
+            return None
+        if snapshot.get("key") != key:
+            logging.debug("Tree snapshot {0} is stale.".format(path))
+            return None
+        groups = dict((group.name, group) for group in self.groups)
+        try:
+            stale = [
+                data["name"] for data in snapshot["scripts"]
+                if RCubicScript.stamp(data["source"]) != data["stamp"]
+            ]
+            if stale:
+                logging.debug(
+                    "Tree snapshot {0} is stale, {1} changed."
+                    .format(path, " ".join(stale))
+                )
+                return None
+            tree = exectree.ExecTree.load(io.BytesIO(snapshot["tree"].encode("utf-8")))
+            scripts = []
+            for data in snapshot["scripts"]:
+                group = groups[data.pop("group")]
+                job = tree.find_job_deep(data.pop("job"))
+                if job is None:
+                    raise KeyError("job of {0}".format(data["name"]))
+                script = RCubicScript.from_snapshot(data, group)
+                script.job = job
+                scripts.append(script)
+        except (KeyError, ValueError, et.XMLSyntaxError, exectree.XMLError, exectree.TreeDefinedError):
+            logging.warning("Ignoring unreadable tree snapshot {0}.".format(path))
+            return None
+
+        for script in scripts:
+            script.group.add_script(script)
+        limits = self._group_limits()
+        iterargs = self.eval_all_args([script for script in scripts if script.iterator])
+        for script in scripts:
+            script.job.limit = limits.get(script.group.name)
+            if script.is_iterated():
+                script.job.subtree.iterator = self.make_iterator(script, iterargs.get(script.name))
+                self.subtrees[script.name] = script.job.subtree
+        self.tree = tree
+        logging.info("Loaded tree snapshot {0}.".format(path))
+        return self.tree
+
+    def _add_phase_barriers(self):
+        """Make scripts of the main tree wait for all scripts of earlier
+        phases. Instead of an edge between every pair of scripts, each phase
+        but the last ends in a barrier job that the next phase depends on."""
+        phases = {}
+        for script in self.scripts():
+            if script.idep is None:
+                phases.setdefault(script.phase, []).append(script)
+        names = dict((value, name) for name, value in self.PHASES.items())
+        barrier = None
+        for phase in sorted(phases):
+            jobs = [script.job for script in phases[phase]]
+            if barrier is not None:
+                for job in jobs:
+                    d = self.tree.add_dep(barrier, job)
+                    d.color = self.tree.colormap("gold2", "gold2")
+                jobs.append(barrier)
+            if phase == max(phases):
+                break
+            barrier = exectree.ExecJob(
+                "PHASE_{0}".format(names[phase]), "-", mustcomplete=False, barrier=True
+            )
+            self.tree.add_job(barrier)
+            for job in jobs:
+                d = self.tree.add_dep(job, barrier)
+                d.color = self.tree.colormap("gold2", "gold2")
+
     def init_tree(self, waitsuccess):
         self.tree = exectree.ExecTree()
         self.tree.cwd = self.workdir
         self.tree.name = "rcubic"
         self.tree.waitsuccess = waitsuccess
+        self.tree.maxparallel = self.maxparallel
+        self._index_scripts()
 
         # Initialize all sub trees
+        iterargs = self.eval_all_args([script for script in self.scripts() if script.iterator])
         for script in self.scripts():
-            if len(script.iterator) > 0:
+            if script.is_iterated():
                 tree = exectree.ExecTree()
                 tree.cwd = self.workdir
                 tree.name = script.name
                 tree.waitsuccess = waitsuccess
-                tree.iterator = exectree.ExecIter(
-                    "{0}_iter".format(script.name),
-                    self.eval_args(script)
-                )
+                tree.iterator = self.make_iterator(script, iterargs.get(script.name))
                 self.subtrees[script.name] = tree
 
         # Initialize Resources
         for resource, limit in self.resources.items():
             exectree.ExecResource(self.tree, resource, limit)
 
+        limits = self._group_limits()
+
         # Initialize jobs and add to trees
         for script in self.scripts():
             script.job = exectree.ExecJob(
@@ -265,20 +620,22 @@ class RCubicScriptParser(object):
                 script.path,
                 logfile=script.logfile,
                 arguments=[script.version],
-                href=script.href
+                href=script.href,
+                limit=limits.get(script.group.name)
             )
             if script.name in self.subtrees:
                 script.job.jobpath = None
                 script.job.subtree = self.subtrees[script.name]
             if script.override:
                 script.job.tcolor = "deepskyblue"
-            for resource in script.resources:
+            for resource, units in script.resources:
                 r = self.tree.find_resource(resource)
                 if r is None:
                     if resource not in self.unusedresources:
                         self.unusedresources.append(resource)
                 else:
                     script.job.resources.append(r)
+                    script.job.weights[r] = units
             if script.idep is None:
                 self.tree.add_job(script.job)
             else:
@@ -308,7 +665,7 @@ class RCubicScriptParser(object):
                     dep = exectree.ExecJob(dep, "-", mustcomplete=False)
                     tree.add_job(dep)
                     d = tree.add_dep(dep, script.job)
-                d.color = {"defined": "deepskyblue", "undefined": "red"}
+                d.color = tree.colormap("deepskyblue", "red")
             for dep in self._glob_expand(script.sdep):
                 try:
                     d = tree.add_dep(dep, script.job)
@@ -316,7 +673,7 @@ class RCubicScriptParser(object):
                     dep = exectree.ExecJob(dep, "-", mustcomplete=False)
                     tree.add_job(dep)
                     d = tree.add_dep(dep, script.job)
-                d.color = {"defined": "lawngreen", "undefined": "palegreen"}
+                d.color = tree.colormap("lawngreen", "palegreen")
             for cdep in self._glob_expand(script.cdep):
                 # logging.debug("adding dep to ")
                 try:
@@ -325,14 +682,8 @@ class RCubicScriptParser(object):
                     cdep = exectree.ExecJob(cdep, "-", mustcomplete=False)
                     tree.add_job(cdep)
                     d = tree.add_dep(script.job, cdep)
-                d.color = {"defined": "lawngreen", "undefined": "palegreen"}
-            # stems = self.tree.stems()
-            for pdep in self.scripts():
-                # if pdep.phase < script.phase and pdep.job in stems:
-                if pdep.phase < script.phase and pdep.idep is None and script.idep is None:
-                    d = tree.add_dep(pdep.job, script.job)
-                    if d is None:
-                        continue
-                    d.color = {"defined": "gold2", "undefined": "gold2"}
+                d.color = tree.colormap("lawngreen", "palegreen")
+        self._add_phase_barriers()
+        self._glob_memo = None
         # logging.debug("tree:\n{0}".format(etree.tostring(self.tree.xml(), pretty_print=True)))
         return self.tree
@@ -24,6 +24,7 @@
 import os
 import sys
 import time
+import signal
 import subprocess
 import re
 import errno
@@ -32,8 +33,14 @@ import sqlite3
 import logging
 from operator import attrgetter
 
+import simplejson
 import gevent
+import gevent.event
 from gevent import socket
+try:
+    from gevent import subprocess as gsubprocess
+except ImportError:
+    gsubprocess = None
 
 
 class VersionCompareError(Exception):
@@ -66,6 +73,12 @@ def popenNonblock(args, data='', stdin=subprocess.PIPE, stdout=subprocess.PIPE,
         f = open(logFile, 'a')
         stdout = f
         stderr = f
+    if gsubprocess is not None:
+        # Child exit is reported by gevent's child watcher, no polling
+        p = gsubprocess.Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, cwd=cwd)
+        output = p.communicate(data or None)[0]
+        return (p.returncode, output or '')
+
     p = subprocess.Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, cwd=cwd)
     real_stdin = p.stdin if stdin == subprocess.PIPE else stdin
     fcntl.fcntl(real_stdin, fcntl.F_SETFL, os.O_NONBLOCK)  # make the file nonblocking
@@ -105,17 +118,102 @@ def popenNonblock(args, data='', stdin=subprocess.PIPE, stdout=subprocess.PIPE,
 
     output = ''.join(chunks)
 
+    return (waitChild(p), output)
+
+
+# Event set when a child exits, then replaced. None until waitChild first
+# runs and installs the SIGCHLD handler.
+_childExit = None
+
+
+def _childExited():
+    global _childExit
+    exited, _childExit = _childExit, gevent.event.Event()
+    exited.set()
+
+
+def waitChild(p, maxdelay=1):
+    """Wait for process p to exit without blocking other greenlets.
+
+    For gevent without child watchers (before 1.0): a SIGCHLD handler wakes
+    waiters whenever a child exits and each polls its own. Polling also
+    backs off from a millisecond up to maxdelay in case a signal is missed.
+    """
+    global _childExit
+    if _childExit is None:
+        _childExit = gevent.event.Event()
+        if gsubprocess is None:
+            gevent.signal(signal.SIGCHLD, _childExited)
+    delay = 0.001
     while True:
+        # Taken before polling so an exit right after it still wakes us
+        exited = _childExit
         returncode = p.poll()
         if returncode is not None:
-            break
-        else:
-            gevent.sleep(1)
+            return returncode
+        exited.wait(delay)
+        delay = min(delay * 2, maxdelay)
+
+
+class JSONCache(object):
+    """Key/value cache persisted as a JSON file.
 
-    return (returncode, output)
+    Entries older than ttl seconds are ignored, with a ttl of None they never expire.
+    """
+
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.used = set()
+        try:
+            with open(self.path) as fd:
+                self.entries = simplejson.load(fd)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    @staticmethod
+    def key(*parts):
+        return simplejson.dumps(parts)
+
+    def _fresh(self, entry, now):
+        return self.ttl is None or entry[0] + self.ttl >= now
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None or not self._fresh(entry, time.time()):
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.used.add(key)
+        return entry[1]
+
+    def set(self, key, value):
+        self.entries[key] = [time.time(), value]
+        self.used.add(key)
+
+    def save(self, prune=False):
+        """Write out fresh entries, replacing the file atomically.
+        With prune only the entries looked up or set since loading are kept."""
+        now = time.time()
+        entries = dict(
+            (k, v) for k, v in self.entries.iteritems()
+            if self._fresh(v, now) and (not prune or k in self.used)
+        )
+        tmp = "{0}.tmp".format(self.path)
+        try:
+            with open(tmp, "w") as fd:
+                simplejson.dump(entries, fd)
+            os.rename(tmp, self.path)
+        except (IOError, OSError, ValueError):
+            logging.warning("Failed to save cache {0}.".format(self.path))
 
 
 class LogToDB(object):
+    # Schema version, bin/rcubic-migratedb brings older databases up to it
+    DB_VERSION = "1.1"
+
     def __init__(self, dbPath):
         self.dbPath = dbPath
         newdb = (not os.path.exists(self.dbPath))
@@ -135,16 +233,27 @@ class LogToDB(object):
             " FOREIGN KEY (time, groupe, job, status) REFERENCES event(time, groupe, job, status), " \
             " UNIQUE (groupe, job))"
         self.conn.execute(query)
-        query = "CREATE TABLE rcubic_db_support(db_version text unique)"
+        # Start and run time of job runs, see jobDurations. Kept apart from
+        # events which only holds done states.
+        query = "CREATE TABLE runs (groupe text, job text, start integer, duration integer)"
+        self.conn.execute(query)
+        query = "CREATE INDEX runs_job ON runs (groupe, job, start)"
+        self.conn.execute(query)
+        # Fingerprints of successful job runs, used in incremental mode
+        query = "CREATE TABLE results (fingerprint text PRIMARY KEY, job text, time integer)"
         self.conn.execute(query)
-        query = 'INSERT INTO rcubic_db_support VALUES("1.0")'
+        query = "CREATE TABLE rcubic_db_support(db_version text unique)"
         self.conn.execute(query)
+        query = "INSERT INTO rcubic_db_support VALUES(?)"
+        self.conn.execute(query, (self.DB_VERSION,))
         self.conn.commit()
 
     def _checkDBVersion(self, conn):
         try:
-            rows = list(self.conn.execute('SELECT db_version from rcubic_db_support where db_version="1.0"'))
+            rows = list(self.conn.execute('SELECT db_version from rcubic_db_support where db_version=?', (self.DB_VERSION,)))
         except:
+            rows = []
+        if not rows:
             raise FatalRuntimeError("Unsupported db_version. Please migrate")
 
     def saveStatus(self, group, version, status, githead=None, job="NONE"):
@@ -172,6 +281,34 @@ class LogToDB(object):
         else:
             return True
 
+    def saveRunStart(self, group, job):
+        """Record that job started running."""
+        self.conn.execute("INSERT INTO runs VALUES (?,?,?,NULL)", (group, str(job), int(time.time())))
+        self.conn.commit()
+        return True
+
+    def saveRunEnd(self, group, job):
+        """Record that the latest run of job succeeded, setting its duration."""
+        query = "UPDATE runs SET duration = ? - start WHERE groupe = ? AND job = ? AND duration IS NULL" \
+            " AND start = (SELECT MAX(start) FROM runs WHERE groupe = ? AND job = ?)"
+        self.conn.execute(query, (int(time.time()), group, str(job), group, str(job)))
+        self.conn.commit()
+        return True
+
+    def jobDurations(self):
+        """Return {(group, job): seconds} average run time of past successful job runs."""
+        query = "SELECT groupe, job, AVG(duration) FROM runs WHERE duration IS NOT NULL GROUP BY groupe, job"
+        return dict(((group, job), duration) for group, job, duration in self.conn.execute(query))
+
+    def hasFingerprint(self, fingerprint):
+        rows = list(self.conn.execute("SELECT 1 FROM results WHERE fingerprint = ?", (fingerprint,)))
+        return len(rows) > 0
+
+    def saveFingerprint(self, fingerprint, job):
+        self.conn.execute("INSERT OR REPLACE INTO results VALUES (?,?,?)", (fingerprint, str(job), int(time.time())))
+        self.conn.commit()
+        return True
+
     # def getUnfinished(self, group=None):
     #	query = "SELECT * FROM latest_events WHERE status = ? "
     #	if group:
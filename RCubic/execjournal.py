@@ -0,0 +1,145 @@
+# vim: ts=4 et filetype=python
+# This file is part of RCubic
+#
+# Copyright (c) 2012 Wireless Generation, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import time
+import logging
+import simplejson
+
+import gevent
+
+from RCubic.exectree import ExecJob
+
+
+class ExecJournal(object):
+    """
+    Append only journal of tree execution: job state changes, iterator
+    positions and resource grants, one JSON document per line.
+
+    Records are buffered and written out with a single fsync at most every
+    interval seconds, a crash loses at most the last interval of events.
+    """
+
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self.buffer = []
+        self._flusher = None
+        self.fd = open(path, "a")
+
+    def record(self, event, **fields):
+        """ Queue an event for the next flush """
+        fields["event"] = event
+        fields["time"] = time.time()
+        self.buffer.append(simplejson.dumps(fields))
+        if self._flusher is None:
+            self._flusher = gevent.spawn_later(self.interval, self.flush)
+
+    def flush(self):
+        """ Write and fsync buffered records """
+        if self._flusher is not None and self._flusher is not gevent.getcurrent():
+            self._flusher.kill()
+        self._flusher = None
+        if not self.buffer:
+            return
+        self.fd.write("\n".join(self.buffer) + "\n")
+        self.buffer = []
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+
+    def close(self):
+        self.flush()
+        self.fd.close()
+
+    @classmethod
+    def replay(cls, path):
+        """ Read journal at path back into an ExecJournalState """
+        state = ExecJournalState()
+        with open(path) as fd:
+            for line in fd:
+                try:
+                    record = simplejson.loads(line)
+                except ValueError:
+                    # Last line may be torn by the crash
+                    logging.warning("Skipping unreadable journal record.")
+                    continue
+                state.apply(record)
+        return state
+
+
+class ExecJournalState(object):
+    """ Execution state rebuilt from a journal """
+
+    def __init__(self):
+        self.header = {}
+        # Last state of jobs by (tree name, job name)
+        self.states = {}
+        # Iterator position by tree name, (run, finished indexes)
+        self.iterations = {}
+        # Resources granted to jobs at the time of the crash
+        self.grants = {}
+
+    def apply(self, record):
+        event = record.get("event")
+        if event == "start":
+            self.header = record
+        elif event == "job":
+            self.states[(record["tree"], record["job"])] = record["state"]
+        elif event == "iteration":
+            run, finished = self.iterations.get(record["tree"], (0, set()))
+            if "index" in record:
+                finished.add(record["index"])
+            else:
+                run = record["run"]
+            self.iterations[record["tree"]] = (run, finished)
+        elif event == "grant":
+            self.grants[(record["tree"], record["job"])] = record["resources"]
+        elif event == "release":
+            self.grants.pop((record["tree"], record["job"]), None)
+
+    def restore(self, tree):
+        """
+        Bring tree back to the journaled state before it is run again:
+        successful jobs stay done, all others will run again. Iterated
+        subtrees continue from the iteration they were in. Handlers linked
+        to job events are not called for restored states.
+        """
+        trees = [tree]
+        for subtree in trees:
+            trees.extend(subtree.subtrees)
+            if subtree.iterator is not None and subtree.name in self.iterations:
+                run, finished = self.iterations[subtree.name]
+                subtree.iterator.restore(run, finished)
+        skipped = 0
+        for job in tree.all_jobs_gen():
+            state = self.states.get((job.tree.name, job.name))
+            if state == ExecJob.STATE_SUCCESSFULL and job.is_defined():
+                job.restore(ExecJob.STATE_SUCCESSFULL)
+                skipped += 1
+        for (treename, jobname) in self.grants:
+            logging.info(
+                "Job {0} of {1} was holding resources, it will run again."
+                .format(jobname, treename)
+            )
+        logging.info("Resuming with {0} jobs already successful.".format(skipped))
+        return skipped
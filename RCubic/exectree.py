@@ -23,7 +23,8 @@
 
 import uuid
 import os
-import random
+import hashlib
+import gc
 import subprocess
 import fcntl
 import errno
@@ -32,13 +33,25 @@ import logging
 import simplejson
 import re
 import fnmatch
+import heapq
+import itertools
+import bisect
+import array
+import mmap
+import tempfile
+from collections import deque, Counter
 
 from lxml import etree as et
 import gevent
+import gevent.pool
 from gevent import (Greenlet, event, socket)
 import pydot
+try:
+    from gevent import subprocess as gsubprocess
+except ImportError:
+    gsubprocess = None
 
-from RCubic.RCubicUtilities import dict_by_attr
+from RCubic.RCubicUtilities import waitChild
 
 
 class TreeDefinedError(RuntimeError):
@@ -78,8 +91,39 @@ class IterratorOverrunError(RuntimeError):
 
 
 # pylint: disable=W0201
+class ExecEvents(dict):
+    """
+    Events of job states by state. Each event is only created once someone
+    asks for it, already set if the job reached that state since its last
+    reset.
+    """
+    __slots__ = ("job",)
+
+    def __init__(self, job):
+        dict.__init__(self)
+        self.job = job
+
+    def __missing__(self, state):
+        if state not in ExecJob.STATES:
+            raise KeyError(state)
+        event = gevent.event.Event()
+        if self.job.fired(state):
+            event.set()
+        self[state] = event
+        return event
+
+
 # class ExecJob(Greenlet):
 class ExecJob(object):
+    __slots__ = (
+        "name", "uuidhex", "_tree", "_state", "subtree", "_jobpath",
+        "execiter", "_mustcomplete", "logfile", "_progress", "override",
+        "arguments", "resources", "weights", "limit", "duration",
+        "priority", "execcount", "failcount", "template", "fingerprint",
+        "cached", "href", "tcolor", "barrier", "_events", "_fired",
+        "_statechange",
+    )
+
     STATES = (0, 1, 2, 3, 4, 5, 6, 7)
     (STATE_IDLE, STATE_RUNNING, STATE_SUCCESSFULL, STATE_FAILED,
         STATE_CANCELLED, STATE_UNDEF, STATE_RESET, STATE_BLOCKED
@@ -106,28 +150,35 @@ class ExecJob(object):
 
     def __init__(self, name="", jobpath=None, tree=None, logfile=None,
                  xml=None, execiter=None, mustcomplete=True, subtree=None,
-                 arguments=None, resources=None, href="", tcolor="lavender"):
-        arguments = arguments or []
+                 arguments=None, resources=None, href="", tcolor="lavender",
+                 limit=None, duration=None, weights=None, barrier=False):
+        arguments = list(arguments or [])
         resources = resources or []
+        weights = weights or {}
         if xml is not None:
             if tree is None:
                 # TODO make tree param required
                 raise TreeUndefinedError("Tree is not known")
             if xml.tag != "execJob":
                 raise XMLError("Expect to find execJob in xml.")
+            attrib = xml.attrib
             try:
-                name = xml.attrib["name"]
-                jobpath = xml.attrib.get("jobpath", None)
-                uuidi = uuid.UUID(xml.attrib["uuid"])
-                mustcomplete = xml.attrib.get("mustcomplete", False) == "True"
-                subtreeuuid = xml.attrib.get("subtreeuuid", None)
-                logfile = xml.attrib.get("logfile", None)
-                href = xml.attrib.get("href", "")
-                tcolor = xml.attrib.get("tcolor", tcolor)
+                name = attrib["name"]
+                jobpath = attrib.get("jobpath", None)
+                uuidhex = uuid.UUID(attrib["uuid"]).hex
+                mustcomplete = attrib.get("mustcomplete", False) == "True"
+                subtreeuuid = attrib.get("subtreeuuid", None)
+                logfile = attrib.get("logfile", None)
+                href = attrib.get("href", "")
+                tcolor = attrib.get("tcolor", tcolor)
+                duration = attrib.get("duration", None)
+                if duration is not None:
+                    duration = float(duration)
+                barrier = attrib.get("barrier", False) == "True"
             except KeyError:
                 logging.error("Required xml attribute is not found.")
                 raise
-            for arg in xml.findall("execArg"):
+            for arg in xml.iterchildren("execArg"):
                 try:
                     arguments.append(arg.attrib["value"])
                 except KeyError:
@@ -140,10 +191,11 @@ class ExecJob(object):
                     )
                     raise
             resources = []
-            for resource in xml.findall("execResource"):
+            for resource in xml.iterchildren("execResource"):
                 fr = tree.find_resource(resource.attrib["uuid"])
                 if fr is not None:
                     resources.append(fr)
+                    weights[fr] = int(resource.attrib.get("units", 1))
             logfile = logfile or None
             if jobpath == "":
                 jobpath = None
@@ -156,35 +208,58 @@ class ExecJob(object):
                     )
 
         else:
-            uuidi = uuid.uuid4()
+            uuidhex = uuid.uuid4().hex
 
-        self.events = dict((e, gevent.event.Event()) for e in self.STATES)
-        self.statechange = gevent.event.Event()
+        # Bit per state whose event has been fired, events are created lazily
+        self._fired = 0
+        self._events = None
+        self._statechange = None
         self.name = name
-        self.uuid = uuidi
-        self._tree = tree
+        self.uuidhex = uuidhex
+        # Tree is only told about state changes once the job is built
+        self._tree = None
         self._state = None
         self.state = self.STATE_IDLE
         self.subtree = subtree
         self._jobpath = None
         self.jobpath = jobpath
         self.execiter = execiter
-        self.mustcomplete = mustcomplete
+        self._mustcomplete = mustcomplete
         self.logfile = logfile
         self._progress = -1
         self.override = False
-        self.arguments = arguments
+        # Arguments of the job alone, those of its trees are added when it
+        # is launched, see argv(). Shared with jobs of the tree having the
+        # same arguments once it is added, see ExecTree.intern_args()
+        self.arguments = tuple(arguments)
         self.resources = resources
+        # Units of resources needed if more than 1, keyed by ExecResource
+        self.weights = weights
+        self.limit = limit
+        # Expected run time in seconds (None if unknown) and the length of
+        # the longest path from this job to the end of the tree, see
+        # ExecTree.prioritize()
+        self.duration = duration
+        self.priority = 0
         self.execcount = 0
         self.failcount = 0
+        # Job this one is a copy of, when running an iteration in parallel
+        self.template = None
+        # Digest of what the job did in incremental mode, cached is set when
+        # the job was skipped because that digest had succeeded before
+        self.fingerprint = None
+        self.cached = False
         self.href = href
         self.tcolor = tcolor
+        # Undefined job synchronizing phases, drawn as a point
+        self.barrier = barrier
+        self._tree = tree
 
     def xml(self):
         """ Generate xml Element object representing of ExecJob """
         args = {
             "name": str(self.name),
-            "uuid": str(self.uuid.hex),
+            "uuid": self.uuidhex,
             "mustcomplete": str(self.mustcomplete),
             "href": str(self.href),
             "tcolor": self.tcolor
@@ -194,19 +269,62 @@ class ExecJob(object):
         elif self.subtree is not None:
             args["subtreeuuid"] = str(self.subtree.uuid.hex)
         args["logfile"] = self.logfile or ""
+        if self.duration is not None:
+            args["duration"] = str(self.duration)
+        if self.barrier:
+            args["barrier"] = str(self.barrier)
         eti = et.Element("execJob", args)
 
         for arg in (self.arguments or []):
             eti.append(et.Element("execArg", {"value": arg}))
 
         for resource in (self.resources or []):
-            eti.append(et.Element("execResource", {"uuid": str(resource.uuid.hex)}))
+            units = self.weights.get(resource, 1)
+            args = {"uuid": resource.uuidhex}
+            if units != 1:
+                args["units"] = str(units)
+            eti.append(et.Element("execResource", args))
 
         return eti
 
     def __str__(self):
         return "<ExecJob {0}>".format(self.name)
 
+    @property
+    def uuid(self):
+        return uuid.UUID(hex=self.uuidhex)
+
+    @property
+    def events(self):
+        """ Events of the job by state, see ExecEvents """
+        if self._events is None:
+            self._events = ExecEvents(self)
+        return self._events
+
+    @property
+    def statechange(self):
+        """ Event set once the state of the job has changed """
+        if self._statechange is None:
+            self._statechange = gevent.event.Event()
+            self._statechange.set()
+        return self._statechange
+
+    def argv(self):
+        """ Return command line of the job: its script, its own arguments,
+        those of its trees, volatile arguments and the tree argument """
+        tree = self.tree
+        args = [self.jobpath]
+        args.extend(self.arguments)
+        args.extend(tree.tree_args())
+        args.extend(tree.tree_args(volatile=True))
+        if tree.argument() is not None:
+            args.append(tree.argument())
+        return args
+
+    def fired(self, state):
+        """ True if state was reached since the job was last reset """
+        return bool(self._fired & (1 << state))
+
     # TODO: setter for sub tree to ensure only subtrees are iterable
 
     @property
@@ -235,9 +353,60 @@ class ExecJob(object):
         if value not in self.STATES:
             raise UnknownStateError("Job state cannot be changed to {0}.".format(value))
         if self._state != value:
+            undef = self.STATE_UNDEF in (self._state, value)
+            tree = self._tree
+            if tree is not None:
+                tree.count_job(self, -1)
             self._state = value
-            self.statechange.set()
-            self.events[self._state].set()
+            if self._statechange is not None:
+                self._statechange.set()
+            if tree is not None:
+                tree.count_job(self, 1)
+                if undef:
+                    # Defined jobs are what connects the graph
+                    tree.graph_changed()
+            self._fire(value)
+            if tree is not None:
+                if self.template is None:
+                    tree.record("job", job=self.name, state=value)
+                tree.check_done()
+            if value == self.STATE_RUNNING and self.template is not None:
+                self.template.state = self.STATE_RUNNING
+
+    def restore(self, state):
+        """ Put job back in a state it reached before a restart. Events of
+        the state are not set, handlers linked to them were already called
+        for it; dependencies on the job are fulfilled through fired() """
+        events = self._events
+        self._events = None
+        try:
+            self.state = state
+        finally:
+            self._events = events
+
+    def _fire(self, state):
+        """ Set event of state and let tree schedule jobs waiting on it """
+        self._fired |= 1 << state
+        if self._events is not None:
+            event = self._events.get(state)
+            if event is not None:
+                event.set()
+        if self._tree is not None:
+            self._tree.job_event(self, state)
+
+    @property
+    def mustcomplete(self):
+        return self._mustcomplete
+
+    @mustcomplete.setter
+    def mustcomplete(self, value):
+        tree = self._tree
+        if tree is not None:
+            tree.count_job(self, -1)
+        self._mustcomplete = value
+        if tree is not None:
+            tree.count_job(self, 1)
+            tree.check_done()
 
     @property
     def tree(self):
@@ -261,8 +430,12 @@ class ExecJob(object):
 
     def _dot_node(self, font):
         label = self.name
+        if self.barrier:
+            return pydot.Node(
+                label, shape="point", width="0.15", color="gold2"
+            )
         kw = {
-            "style": "filled",
+            "style": "filled,dashed" if self.cached else "filled",
             "fillcolor": self.STATE_COLORS[self.state],
             "color": self.tcolor,
             "penwidth": "3",
@@ -308,16 +481,15 @@ class ExecJob(object):
         Return true if job has referenced by some dependency
         Used to check if job is connected to tree
         """
-        # caching results will peformance
-        return any(parent.is_defined() or parent.has_defined_anscestors() for parent in self.parents())
+        return self in self.tree.analysis()[0]
 
     def parent_deps(self):
         """ Return all jobs which are parents of this job """
-        return [dep for dep in self.tree.deps if self == dep.child]
+        return list(self.tree.parent_deps.get(self, ()))
 
     def child_deps(self):
         """ Return all jobs which are children of this job """
-        return [dep for dep in self.tree.deps if self == dep.parent]
+        return list(self.tree.child_deps.get(self, ()))
 
     def children(self):
         return [dep.child for dep in self.child_deps()]
@@ -327,7 +499,7 @@ class ExecJob(object):
 
     def orphan(self):
         """ True if job has no parents """
-        return not self.parent_deps()
+        return not self.tree.parent_deps.get(self)
 
     def validate(self, prepend=""):
         """ Ensure job can perform what is required of it at execution """
@@ -348,6 +520,13 @@ class ExecJob(object):
         else:
             errors.append("subtree or jobpath of {0} must be set.")
 
+        for resource, units in self.resource_units().iteritems():
+            if 0 < resource.avail < units:
+                errors.append(
+                    "{0}Job {1} needs {2} units of resource {3} which only has {4}."
+                    .format(prepend, self.name, units, resource.name, resource.avail)
+                )
+
         return errors
 
     def is_done(self):
@@ -373,11 +552,20 @@ class ExecJob(object):
     def _popen(args, data='', stdin=subprocess.PIPE, stdout=subprocess.PIPE,
                stderr=subprocess.STDOUT, cwd=None):
         """Communicate with the process non-blockingly.
-        http://code.google.com/p/gevent/source/browse/examples/processes.py?r=2
-        3469225e58196aeb89393ede697e6d11d88844b
 
-        This is to be obsoleted with gevent subprocess
+        With gevent subprocess the exit of the child is picked up by a child
+        watcher, so the return is immediate. Older gevent falls back to
+        polling the child.
         """
+        if gsubprocess is not None:
+            p = gsubprocess.Popen(
+                args, stdin=stdin, stdout=stdout, stderr=stderr, cwd=cwd
+            )
+            p.communicate(data or None)
+            return p.returncode
+
+        # http://code.google.com/p/gevent/source/browse/examples/processes.py?r=2
+        # 3469225e58196aeb89393ede697e6d11d88844b
         p = subprocess.Popen(
             args, stdin=stdin, stdout=stdout, stderr=stderr, cwd=cwd
         )
@@ -416,22 +604,19 @@ class ExecJob(object):
                 socket.wait_read(p.stdout.fileno())
             p.stdout.close()
 
-        while True:
-            returncode = p.poll()
-            if returncode is not None:
-                break
-            else:
-                gevent.sleep(1)
-
-        return returncode
+        return waitChild(p)
 
     def reset(self):
         """ Prepares jobs to be executed again """
         if self.state != self.STATE_UNDEF:
-            for event in self.events.values():
-                event.clear()
+            if self._events is not None:
+                for event in self._events.values():
+                    event.clear()
+            self._fired = 0
             if self.progress > 0:
                 self.progress = 0
+            self.fingerprint = None
+            self.cached = False
             self.state = self.STATE_RESET
             logging.debug("job {0} has been reset.".format(self.name))
 
@@ -449,38 +634,66 @@ class ExecJob(object):
         self.state = self.STATE_CANCELLED
         return True
 
-    def _release_resources(self, resources):
-        logging.debug("releasing: {0}".format(resources))
-        for r in resources:
-            r.release()
+    def resource_units(self):
+        """ Return {resource: units} the job needs to run """
+        return dict(
+            (resource, self.weights.get(resource, 1))
+            for resource in self.resources
+        )
+
+    def _release_resources(self, units):
+        if not units:
+            return
+        logging.debug("releasing: {0}".format(units.keys()))
+        self.resources[0].queue.release(units)
+        self.tree.record("release", job=self.name)
+
+    def limits(self):
+        """ Return concurrency limits that apply to job processes, own
+        limit first then those of our tree and its supertrees """
+        limits = [self.limit] if self.limit is not None else []
+        tree = self.tree
+        while tree is not None:
+            limits.append(tree.limit)
+            tree = tree.supertree
+        return limits
+
+    def _acquire_slots(self):
+        limits = self.limits()
+        if not all(limit.available() for limit in limits):
+            self.state = self.STATE_BLOCKED
+        acquired = []
+        try:
+            for limit in limits:
+                limit.acquire(self.priority)
+                acquired.append(limit)
+        except:
+            self._release_slots(acquired)
+            raise
+        return acquired
+
+    def _release_slots(self, limits):
+        for limit in reversed(limits):
+            limit.release()
 
-    def _acquire_resources(self, max_attempts=1000):
+    def _acquire_resources(self):
+        """ Block until all resources needed by the job are granted at
+        once, return the granted units """
         if len(self.resources) < 1:
-            return True
-        self.state = self.STATE_BLOCKED
-        reserved = []
-        lastacquire = False
-        min_timeout = min(resource.reserve_timeout for resource in self.resources)
-        backofftime = len(self.resources) * min_timeout
-        attempt = 0
-        while True:
-            for resource in self.resources:
-                if resource.reserve():
-                    reserved.append(resource)
-                    lastacquire = True
-                else:
-                    lastacquire = False
-                    break
-            if not lastacquire:
-                attempt += 1
-                self._release_resources(reserved)
-                gevent.sleep(backofftime + random.randint(0, min_timeout))
-                if max_attempts > 0 and attempt >= max_attempts:
-                    break
-            else:
-                break
-        self.state = self.STATE_IDLE
-        return lastacquire
+            return {}
+        units = self.resource_units()
+        # Resources of a job all belong to one forest and share its queue
+        queue = self.resources[0].queue
+        if not queue.acquire(units, self.priority, timeout=0):
+            self.state = self.STATE_BLOCKED
+            queue.acquire(units, self.priority)
+            self.state = self.STATE_IDLE
+        self.tree.record(
+            "grant",
+            job=self.name,
+            resources=dict((r.name, n) for r, n in units.iteritems())
+        )
+        return units
 
     def read_log(self, size):
         """ Read in the log file for job, up to size bytes.
@@ -507,8 +720,8 @@ class ExecJob(object):
                 self.name, self.state
             )
             )
-            self.events[self.STATE_RUNNING].set()
-            self.events[self.STATE_SUCCESSFULL].set()
+            self._fire(self.STATE_RUNNING)
+            self._fire(self.STATE_SUCCESSFULL)
             return True
         # Using STATE_SUCCESSFULL instead of is_successfull because we don't want to skip starting undef jobs
         elif self.state == self.STATE_SUCCESSFULL:
@@ -516,37 +729,97 @@ class ExecJob(object):
         Greenlet.spawn(self._run)
         return True
 
+    def launch(self):
+        """ Execute job whose dependencies are already fulfilled, used by
+        the tree ready queue instead of start()"""
+        if self.state == self.STATE_UNDEF:
+            logging.debug("{0} has nothing to do.".format(self.name))
+            if self.tree.inherited("resultcache") is not None:
+                # Children fingerprint through us
+                self.fingerprint = self._fingerprint()
+            self._fire(self.STATE_RUNNING)
+            self._fire(self.STATE_SUCCESSFULL)
+        elif self.state not in self.DONE_STATES:
+            Greenlet.spawn(self._execute)
+
     def _run(self):
         logging.debug("{0} is idling ({1})".format(self.name, self.state))
         self._parent_wait()
+        return self._execute()
 
+    def _upstream(self):
+        """ Return digest of the fingerprints of the parents and of what is
+        upstream of our tree, None if one of them is unknown """
+        if self.tree.upstream is None:
+            return None
+        sha = hashlib.sha1(self.tree.upstream)
+        for parent in sorted(self.parents(), key=lambda job: job.name):
+            if parent.fingerprint is None:
+                return None
+            sha.update("\0{0}:{1}".format(parent.fingerprint, parent.state))
+        return sha.hexdigest()
+
+    def _fingerprint(self):
+        """ Return digest of the script, its arguments and of what is
+        upstream of it, None if the job cannot be fingerprinted """
+        if self.subtree is not None:
+            return None
+        upstream = self._upstream()
+        if upstream is None:
+            return None
+        sha = hashlib.sha1()
+        parts = [self.name, upstream]
+        if self.state != self.STATE_UNDEF:
+            parts.extend(self.arguments)
+            parts.extend(self.tree.tree_args())
+            parts.append(self.tree.argument() or "")
+            try:
+                with open(self.jobpath, "rb") as fd:
+                    for chunk in iter(lambda: fd.read(65536), ""):
+                        sha.update(chunk)
+            except IOError:
+                return None
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode("utf-8")
+            sha.update("\0")
+            sha.update(part)
+        return sha.hexdigest()
+
+    def _execute(self):
+        cache = self.tree.inherited("resultcache")
+        if cache is not None and (self.state == self.STATE_UNDEF or self.state not in self.DONE_STATES):
+            self.fingerprint = self._fingerprint()
+            if self.subtree is not None:
+                self.subtree.upstream = self._upstream()
         if self.state == self.STATE_UNDEF:
             logging.debug("{0} has nothing to do.".format(self.name))
-            self.events[self.STATE_RUNNING].set()
-            self.events[self.STATE_SUCCESSFULL].set()
+            self._fire(self.STATE_RUNNING)
+            self._fire(self.STATE_SUCCESSFULL)
             return True
         elif self.state in self.DONE_STATES:
             logging.debug("Aborting start of, {0} is already in done state.".format(self.name))
             return None
+        elif self.fingerprint is not None and cache.hasFingerprint(self.fingerprint):
+            logging.info("{0} is unchanged since it last succeeded, skipping.".format(self.name))
+            self.cached = True
+            self.state = self.STATE_RUNNING
+            self.state = self.STATE_SUCCESSFULL
+            return True
 
-        if not self._acquire_resources():
-            self.state = self.STATE_FAILED
-            logging.warning(
-                "Resource deadlock prevention exceeded max attemps for {0}.".
-                format(self.name)
-            )
-            return False
-
+        # Slots first: a job waiting for one must not sit on resources others
+        # could run with
+        slots = []
+        units = {}
         try:
+            if self.jobpath is not None:
+                slots = self._acquire_slots()
+            units = self._acquire_resources()
             logging.debug("{0} is starting".format(self.name))
             self.state = self.STATE_RUNNING
             # rcubic.refreshStatus(self)
             if self.jobpath is not None:
-                args = [self.jobpath]
-                if self.arguments is not None:
-                    args.extend(self.arguments)
-                if self.tree.argument() is not None:
-                    args.append(self.tree.argument())
+                args = self.argv()
                 logging.debug("starting {0} {1}".format(self.name, args))
                 if self.logfile is not None:
                     with open(self.logfile, 'a') as fd:
@@ -563,16 +836,27 @@ class ExecJob(object):
                     )
             elif self.subtree is not None:
                 logging.debug("starting {0} {1}".format(self.name, "subtree"))
-                self.subtree.iterrun()
-                rcode = int(not self.subtree.is_success())
+                try:
+                    self.subtree.iterrun()
+                    rcode = int(not self.subtree.is_success())
+                except subprocess.CalledProcessError, ex:
+                    logging.error(
+                        "Iterator of {0} exited with {1}: {2}".format(
+                            self.name, ex.returncode, (ex.output or "").strip()
+                        )
+                    )
+                    rcode = ex.returncode
             else:
                 logging.error("Hit unhandled start state for {0}.".format(self.name))
             logging.debug("finished {0} status {1}.".format(self.name, rcode))
         finally:
-            self._release_resources(self.resources)
+            self._release_resources(units)
+            self._release_slots(slots)
 
         self.execcount += 1
         if rcode == 0:
+            if self.fingerprint is not None:
+                cache.saveFingerprint(self.fingerprint, self.name)
             self.state = self.STATE_SUCCESSFULL
             return True
         else:
@@ -581,12 +865,83 @@ class ExecJob(object):
             return False
 
 
+class ExecArgStore(object):
+    """
+    Read only sequence of iterator arguments kept in a memory mapped
+    temporary file, with an array of where each argument ends. Indexing is
+    O(1) and arguments only become python strings when they are read, so
+    memory use does not grow with python objects per argument. Arguments
+    smaller than SPILL bytes in total are kept in a string instead.
+    """
+
+    SPILL = 1 << 16
+
+    def __init__(self, args=()):
+        self._ends = array.array("L")
+        end = 0
+        chunk = []
+        pending = 0
+        fd = None
+        try:
+            for arg in args:
+                if isinstance(arg, unicode):
+                    arg = arg.encode("utf-8")
+                else:
+                    arg = str(arg)
+                end += len(arg)
+                self._ends.append(end)
+                chunk.append(arg)
+                pending += len(arg)
+                if pending >= self.SPILL:
+                    if fd is None:
+                        fd = tempfile.TemporaryFile(prefix="rcubic_iter")
+                    fd.write("".join(chunk))
+                    chunk = []
+                    pending = 0
+            if fd is None:
+                self._data = "".join(chunk)
+            else:
+                fd.write("".join(chunk))
+                fd.flush()
+                # The mapping outlives the file, which is already unlinked
+                self._data = mmap.mmap(
+                    fd.fileno(), end, access=mmap.ACCESS_READ
+                )
+        finally:
+            if fd is not None:
+                fd.close()
+
+    def __len__(self):
+        return len(self._ends)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self._ends)
+        if not 0 <= index < len(self._ends):
+            raise IndexError("argument index out of range")
+        start = self._ends[index - 1] if index > 0 else 0
+        return self._data[start:self._ends[index]]
+
+    def __iter__(self):
+        start = 0
+        for end in self._ends:
+            yield self._data[start:end]
+            start = end
+
+
 class ExecIter(object):
-    def __init__(self, name=None, args=None):
-        self.args = args or []
+    def __init__(self, name=None, args=None, parallel=1):
+        # Arguments are shared by copies of the iterator, see copy()
+        if not isinstance(args, ExecArgStore):
+            args = ExecArgStore(args or [])
+        self.args = args
         self.run = 0
         self.valid = None
         self.name = name
+        # Number of iterations that may run at once, each in its own copy
+        # of the tree. In parallel mode run counts finished iterations.
+        self.parallel = parallel
+        self.finished = set()
 
     def __str__(self):
         return "<ExecIter {0}>".format(self.name)
@@ -602,6 +957,12 @@ class ExecIter(object):
         """ Number of elements in iterator"""
         return len(self.args)
 
+    def validate(self):
+        """ Ensure iterator has something to iterate over """
+        if self.len() < 1:
+            return ["Iterator needs at least one argument to run."]
+        return []
+
     def increment(self, inc=1):
         """ Advance iterator to next argument """
         self.run += inc
@@ -616,76 +977,398 @@ class ExecIter(object):
             return self.args[-1]
         return self.args[self.run]
 
+    def pending(self):
+        """ Generate (index, argument) of iterations not yet finished """
+        for index, argument in enumerate(self.args):
+            if index not in self.finished:
+                yield index, argument
+
+    def finish(self, index):
+        """ Record iteration index as successfully finished """
+        self.finished.add(index)
+        self.run = len(self.finished)
+
+    def restore(self, run, finished):
+        """ Continue from a journaled position, run is used in sequential
+        mode and the finished indexes in parallel mode """
+        self.finished = set(finished)
+        if self.parallel > 1:
+            self.run = len(self.finished)
+        else:
+            self.run = run
+
+    def copy(self):
+        """ Return a new iterator over the same arguments """
+        return ExecIter(self.name, self.args, self.parallel)
+
+
+class ExecStreamIter(ExecIter):
+    """
+    Iterator reading its arguments as they are needed from the output of
+    command or from the file at path, so iterations can start before the
+    list is complete. Only the current argument is kept, and in parallel
+    mode those of iterations which have not finished yet.
+
+    The source is only opened once the tree runs. len() is the number of
+    arguments read so far, which is the total once the source is exhausted.
+    A command exiting with an error fails the iteration, raising
+    CalledProcessError with its stderr as output.
+    """
+
+    SEPARATOR = re.compile(r"[,;\s]+")
+
+    def __init__(self, name=None, command=None, path=None, cwd=None,
+                 parallel=1):
+        ExecIter.__init__(self, name, parallel=parallel)
+        self.command = command
+        self.path = path
+        self.cwd = cwd
+        self._tokens = None
+        self._current = None
+        self._read = 0
+        # Arguments of started iterations that have not finished, by index
+        self.retry = {}
+        # Indexes finished before a restore, skipped when read
+        self._skip = set()
+        # Arguments consumed before a restore in sequential mode
+        self._done = 0
+        # Failure of the command, raised again on later reads
+        self.error = None
+
+    def _chunks(self):
+        if self.path is not None:
+            with open(self.path) as fd:
+                for chunk in iter(lambda: fd.read(4096), ""):
+                    yield chunk
+            return
+        popen = gsubprocess.Popen if gsubprocess is not None else subprocess.Popen
+        # A file rather than a pipe nobody reads while stdout is read
+        with tempfile.TemporaryFile(prefix="rcubic_iter") as stderr:
+            p = popen(
+                self.command,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                cwd=self.cwd
+            )
+            fd = p.stdout.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+            try:
+                while True:
+                    try:
+                        chunk = os.read(fd, 4096)
+                    except OSError, ex:
+                        if ex.errno != errno.EAGAIN:
+                            raise
+                        socket.wait_read(fd)
+                        continue
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                p.stdout.close()
+                if gsubprocess is not None:
+                    rcode = p.wait()
+                else:
+                    rcode = waitChild(p)
+            if rcode != 0:
+                stderr.seek(0)
+                raise subprocess.CalledProcessError(
+                    rcode, self.command, stderr.read()
+                )
+
+    def _split(self):
+        tail = ""
+        for chunk in self._chunks():
+            parts = self.SEPARATOR.split(tail + chunk)
+            tail = parts.pop()
+            for part in parts:
+                if part:
+                    yield part
+        if tail:
+            yield tail
+
+    def _peek(self):
+        """ Return next unread argument without consuming it, None at the
+        end of the source """
+        if self.error is not None:
+            raise self.error
+        if self._current is None:
+            try:
+                if self._tokens is None:
+                    self._tokens = self._split()
+                    while self._read < self._done:
+                        if next(self._tokens, None) is None:
+                            break
+                        self._read += 1
+                self._current = next(self._tokens, None)
+            except subprocess.CalledProcessError, ex:
+                self.error = ex
+                raise
+            if self._current is not None:
+                self._read += 1
+        return self._current
+
+    def is_exhausted(self):
+        """ Return true when there is nothing left in exec iterator"""
+        return not self.retry and self._peek() is None
+
+    def len(self):
+        """ Number of arguments read so far, does not read the source """
+        return self._read
+
+    def validate(self):
+        """ Nothing to check without running the command, an empty source
+        runs no iteration """
+        return []
+
+    def increment(self, inc=1):
+        """ Advance iterator to next argument """
+        for i in range(inc):
+            self._peek()
+            self._current = None
+            self.run += 1
+        return self._peek() is not None
+
+    @property
+    def argument(self):
+        """ Return current argument """
+        return self._peek() or ""
+
+    def pending(self):
+        """ Generate (index, argument) of iterations not yet finished,
+        reading the source as they are started """
+        for index in sorted(self.retry):
+            yield index, self.retry[index]
+        while self._peek() is not None:
+            index = self._read - 1
+            argument = self._current
+            self._current = None
+            if index in self._skip:
+                self._skip.discard(index)
+                continue
+            self.retry[index] = argument
+            yield index, argument
+
+    def finish(self, index):
+        """ Record iteration index as successfully finished """
+        self.retry.pop(index, None)
+        self.run += 1
+
+    def restore(self, run, finished):
+        """ Continue from a journaled position, skipping arguments of
+        iterations that were done """
+        if self.parallel > 1:
+            self._skip = set(finished)
+            self.run = len(self._skip)
+        elif self._tokens is None:
+            self._done = self.run = run
+        elif run > self.run:
+            self.increment(run - self.run)
+
+    def copy(self):
+        """ Return a new iterator over the same source """
+        return ExecStreamIter(
+            self.name, self.command, self.path, self.cwd, self.parallel
+        )
+
+
+class ExecLimit(object):
+    """ Cap on how many job processes may run at once. Jobs over the limit
+    wait for a slot by priority, in FIFO order among equal priorities.
+    A limit of 0 or less is unlimited. """
+
+    def __init__(self, limit=0):
+        self._limit = limit
+        self.used = 0
+        # Heap of (-priority, sequence, event)
+        self.waiters = []
+        self._seq = itertools.count()
+
+    def __str__(self):
+        return "<ExecLimit {0}/{1}>".format(self.used, self._limit)
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @limit.setter
+    def limit(self, value):
+        self._limit = value
+        while self.waiters and self.available():
+            self.used += 1
+            heapq.heappop(self.waiters)[2].set()
+
+    def available(self):
+        """ True if a slot can be acquired without waiting """
+        return self._limit <= 0 or self.used < self._limit
+
+    def acquire(self, priority=0):
+        """ Block until a slot is ours """
+        if self.available() and not self.waiters:
+            self.used += 1
+            return
+        waiter = (-priority, next(self._seq), gevent.event.Event())
+        heapq.heappush(self.waiters, waiter)
+        try:
+            waiter[2].wait()
+        except:
+            # Killed while waiting, give back the slot if we were handed one
+            if waiter[2].is_set():
+                self.release()
+            else:
+                self.waiters.remove(waiter)
+                heapq.heapify(self.waiters)
+            raise
+
+    def release(self):
+        """ Hand slot over to the next waiter or give it back """
+        if self.waiters and (self._limit <= 0 or self.used <= self._limit):
+            heapq.heappop(self.waiters)[2].set()
+        else:
+            self.used = max(0, self.used - 1)
+
+
+class ExecResourceQueue(object):
+    """ Grants jobs all the resources they need at once.
+
+    Requests are served by priority, then in arrival order. A request that
+    does not fit holds back later requests for the limited resources it needs
+    so it cannot be starved, later requests for other resources go ahead.
+    Waiters are woken as soon as a release lets them in.
+    """
+
+    def __init__(self):
+        # Sorted list of (-priority, sequence, units, event)
+        self.waiters = []
+        self._seq = itertools.count()
+
+    @staticmethod
+    def fits(units):
+        """ True if there is room for units ({resource: count}) now """
+        return all(
+            resource.avail < 0 or resource.used + count <= resource.avail
+            for resource, count in units.iteritems()
+        )
+
+    def _dispatch(self):
+        held = set()
+        waiting = []
+        for waiter in self.waiters:
+            units = waiter[2]
+            if held.isdisjoint(units) and self.fits(units):
+                for resource, count in units.iteritems():
+                    resource.used += count
+                waiter[3].set()
+            else:
+                # Unlimited resources, like default, never need holding back
+                held.update(
+                    resource for resource in units
+                    if 0 <= resource.avail < float("inf")
+                )
+                waiting.append(waiter)
+        self.waiters = waiting
+
+    def acquire(self, units, priority=0, timeout=None):
+        """ Block until units ({resource: count}) are all ours.
+        Return False if they could not be granted within timeout """
+        waiter = (-priority, next(self._seq), units, gevent.event.Event())
+        bisect.insort(self.waiters, waiter)
+        self._dispatch()
+        try:
+            if not waiter[3].is_set():
+                waiter[3].wait(timeout)
+        except:
+            self._withdraw(waiter)
+            raise
+        if not waiter[3].is_set():
+            self._withdraw(waiter)
+            return False
+        return True
+
+    def _withdraw(self, waiter):
+        if waiter[3].is_set():
+            self.release(waiter[2])
+        else:
+            self.waiters.remove(waiter)
+            self._dispatch()
+
+    def release(self, units):
+        """ Give back units and grant what now fits """
+        for resource, count in units.iteritems():
+            resource.used = max(0, resource.used - count)
+        self._dispatch()
+
 
 class ExecResource(object):
+    __slots__ = ("name", "avail", "used", "uuidhex", "reserve_timeout", "tree")
+
     def __init__(self, tree, name="", avail=0, xml=None, reserve_timeout=60):
         if xml is not None:
             if xml.tag != "execResource":
                 raise XMLError("Expect to find execResource in xml.")
             name = xml.attrib.get("name", "")
-            uuidi = uuid.UUID(xml.attrib["uuid"])
-            avail = xml.attrib.get("avail", -1)
+            uuidhex = uuid.UUID(xml.attrib["uuid"]).hex
+            avail = float(xml.attrib.get("avail", -1))
+            if avail != float("inf"):
+                avail = int(avail)
         else:
-            uuidi = uuid.uuid4()
+            uuidhex = uuid.uuid4().hex
         self.name = name
         self.avail = avail
         self.used = 0
-        self.event = gevent.event.Event()
-        self.uuid = uuidi
+        self.uuidhex = uuidhex
         self.reserve_timeout = reserve_timeout
-        tree.resources.append(self)
+        self.tree = tree
+        tree.add_resource(self)
 
     def __str__(self):
         return "<ExecResource {0}>".format(self.name)
 
+    @property
+    def queue(self):
+        """ Queue granting the resource. Jobs may hold resources of their
+        tree and of its supertrees, so the whole forest shares the queue of
+        its root tree. """
+        return self.tree.root().resource_queue
+
+    @property
+    def uuid(self):
+        return uuid.UUID(hex=self.uuidhex)
+
     def xml(self):
         """ Return xml representation of ExecResource object """
         args = {
             "name": str(self.name),
-            "uuid": str(self.uuid.hex),
+            "uuid": self.uuidhex,
             "avail": str(self.avail),
         }
         return et.Element("execResource", args)
 
-    def reserve(self, blocking=True):
+    def reserve(self, blocking=True, priority=0, units=1):
         """ Acquire reservation of ExecResource object
 
         Keyword arguments:
-        blocking -- return when resource is available (default: True)
-        timeout -- if non blocking set timeout in seconds or None (default)
+        blocking -- wait up to reserve_timeout seconds for the resource
+        priority -- waiting reservations are granted highest priority first
+        units -- how many units of the resource to reserve
         """
-        if self.avail < 0:
-            return True
-        if self.used < self.avail:
-            self.used += 1
-        elif blocking:
-            with gevent.Timeout(self.reserve_timeout) as tobject:
-                try:
-                    while self.used >= self.avail:
-                        if self.event.wait(1):
-                            self.event.clear()
-                    self.used += 1
-                except gevent.timeout.Timeout as gtimeout:
-                    if tobject != gtimeout:
-                        raise
-                    return False
-
-        else:
-            return False
-        return True
+        timeout = self.reserve_timeout if blocking else 0
+        return self.queue.acquire({self: units}, priority, timeout)
 
-    def release(self):
+    def release(self, units=1):
         """ Release a previously acquired resource """
-        if self.avail >= 0:
-            self.used = max(0, self.used - 1)
-            self.event.set()
+        self.queue.release({self: units})
 
 
 class ExecDependency(object):
+    __slots__ = ("parent", "child", "color", "state")
+    # Replace, do not modify it, see ExecTree.colormap()
+    DEFAULT_COLOR = {"defined": "deepskyblue", "undefined": "palegreen"}
+
     def __init__(self, parent, child, state=ExecJob.STATE_SUCCESSFULL):
         self.parent = parent
         self.child = child
-        self.color = {"undefined": "palegreen", "defined": "deepskyblue"}
+        self.color = self.DEFAULT_COLOR
 
         if state in ExecJob.STATES:
             self.state = state
@@ -735,13 +1418,18 @@ class ExecDependency(object):
 
     def wait(self):
         """ Block untill dependency is complete """
-        self.parent.events[self.state].wait()
+        if not self.is_fulfilled():
+            self.parent.events[self.state].wait()
+
+    def is_fulfilled(self):
+        """ True if child no longer needs to wait on this dependency """
+        return self.parent.fired(self.state)
 
     def xml(self):
         """ Generate xml Element object representing the depedency """
         args = {
-            "parent": self.parent.uuid.hex,
-            "child": self.child.uuid.hex,
+            "parent": self.parent.uuidhex,
+            "child": self.child.uuidhex,
             "state": str(self.state),
             "dcolor": self.color["defined"],
             "ucolor": self.color["undefined"]
@@ -751,16 +1439,73 @@ class ExecDependency(object):
 
 
 class ExecTree(object):
-    def __init__(self, xml=None):
+    def __init__(self, xml=None, supertree=None):
+        """ Build an empty tree or load it from xml, supertree is the tree
+        the xml is nested in """
         self.jobs = []
         self.deps = []
+        # Adjacency indexes of self.deps keyed by job, kept in sync by add_dep
+        self.parent_deps = {}
+        self.child_deps = {}
+        self._analysis = None
         self.subtrees = []
+        self.supertree = supertree
+        # Lookup indexes by name and uuid hex, _deep_jobs covers all nested
+        # subtrees so lookups do not need to walk the forest
+        self._jobs_by_name = {}
+        self._jobs_by_uuid = {}
+        self._deep_jobs = {}
+        self._subtrees_by_uuid = {}
+        self._resources_by_name = {}
+        self._resources_by_uuid = {}
         self.done_event = gevent.event.Event()
         self._done = False
+        # Number of mustcomplete jobs, and how many of those are done and
+        # successful. Kept up to date by count_job as job states change.
+        self._must_total = 0
+        self._must_done = 0
+        self._must_success = 0
         self.resources = []
+        # Grants resources of the forest if this is its root tree, see
+        # ExecResource.queue
+        self.resource_queue = ExecResourceQueue()
+        self.limit = ExecLimit()
+        # Copies of the tree running iterations in parallel by index, only
+        # kept while they run or if they did not succeed
+        self.instances = {}
+        # Summary state of finished parallel iterations by index, -1 for
+        # those not finished
+        self.completed = array.array("b")
+        # ExecJournal recording execution of the tree and its subtrees
+        self.journal = None
+        # Incremental mode: store of fingerprints of jobs that succeeded,
+        # see ExecJob._fingerprint()
+        self.resultcache = None
+        # Digest of what is upstream of the job running the tree, set by the
+        # job in incremental mode. None if it could not be fingerprinted.
+        self.upstream = ""
         self.cancelled = False
         self.started = False
+        # Cancel the tree as soon as one of its jobs fails, set on copies
+        # running parallel iterations
+        self.failfast = False
+        # Schedule jobs through a ready queue when their dependencies are
+        # fulfilled instead of spawning a waiting greenlet per job. The
+        # queue is a heap of (-priority, sequence, job).
+        self.readyqueue = True
+        self._pending = None
+        self._readyq = []
+        self._readyseq = itertools.count()
+        self._draining = False
         self.legend = {}
+        # Job argument tuples and dependency color maps shared within the
+        # tree, see intern_args() and colormap()
+        self._arguments = {}
+        self._colormaps = {}
+        # Arguments passed to all jobs of the tree and its subtrees after
+        # their own, volatile ones are not saved to xml. See extend_args()
+        self.arguments = ()
+        self.volatile = ()
         if xml is None:
             self.uuid = uuid.uuid4()
             self.name = ""
@@ -770,39 +1515,148 @@ class ExecTree(object):
             self.iterator = None
             self.waitsuccess = False
         else:
-            if xml.tag != "execTree":
-                raise XMLError("Expect to find execTree in xml.")
-            if xml.attrib["version"] != "1.0":
-                raise XMLError("Tree config file version is not supported")
-            self.name = xml.attrib.get("name", "")
-            self.href = xml.attrib.get("href", "")
-            self.uuid = uuid.UUID(xml.attrib["uuid"])
-            self.cwd = xml.attrib.get("cwd", "/")
-            self.waitsuccess = (
-                not xml.attrib.get("waitsuccess", "False") == "False"
-            )
+            self._load_attrib(xml)
+            for xmlarg in xml.findall("execArg"):
+                self.arguments += (xmlarg.attrib["value"],)
             for xmlres in xml.findall("execResource"):
                 ExecResource(self, xml=xmlres)
             for xmlsubtree in xml.findall("execTree"):
-                self.subtrees.append(ExecTree(xmlsubtree))
+                self._add_subtree(ExecTree(xmlsubtree, self))
             for xmljob in xml.findall("execJob"):
-                self.jobs.append(ExecJob(tree=self, xml=xmljob))
+                self._index_job(ExecJob(tree=self, xml=xmljob))
+            self.graph_changed()
             for xmldep in xml.findall("execDependency"):
                 self.add_dep(xml=xmldep)
             for legenditem in xml.findall("legendItem"):
-                try:
-                    key = legenditem.attrib["name"]
-                    value = legenditem.attrib["value"]
-                    self.legend[key] = value
-                except KeyError:
-                    logging.error(
-                        "Legend item is missing required xml attribute" "\
-                        ({0}:{1}).".format(
-                        legenditem.base,
-                        legenditem.sourceline
-                    )
-                    )
-                    raise
+                self._load_legend(legenditem)
+
+    def _load_attrib(self, xml):
+        """ Set up tree from attributes of execTree element """
+        if xml.tag != "execTree":
+            raise XMLError("Expect to find execTree in xml.")
+        if xml.attrib["version"] != "1.0":
+            raise XMLError("Tree config file version is not supported")
+        self.name = xml.attrib.get("name", "")
+        self.href = xml.attrib.get("href", "")
+        self.uuid = uuid.UUID(xml.attrib["uuid"])
+        self.cwd = xml.attrib.get("cwd", "/")
+        self.workdir = "/tmp/{0}".format(self.uuid)
+        self.iterator = None
+        self.waitsuccess = (
+            not xml.attrib.get("waitsuccess", "False") == "False"
+        )
+        self.maxparallel = int(xml.attrib.get("maxparallel", 0))
+
+    def _load_legend(self, legenditem):
+        try:
+            key = legenditem.attrib["name"]
+            value = legenditem.attrib["value"]
+            self.legend[key] = value
+        except KeyError:
+            logging.error(
+                "Legend item is missing required xml attribute" "\
+                ({0}:{1}).".format(
+                legenditem.base,
+                legenditem.sourceline
+            )
+            )
+            raise
+
+    def _load_dep(self, attrib):
+        """ Add dependency from attributes of execDependency element """
+        dep = self.add_dep(
+            attrib["parent"], attrib["child"], int(attrib["state"])
+        )
+        if dep is not None:
+            dep.color = self.colormap(attrib["dcolor"], attrib["ucolor"])
+        return dep
+
+    @classmethod
+    def load(cls, source):
+        """
+        Load tree written by write() or xml() from a path or file object.
+
+        The document is parsed incrementally and elements are dropped as
+        soon as they are loaded. Dependencies are bound once all jobs of
+        their tree are known and resources of jobs once the whole document
+        is read, so the order of elements does not matter.
+        """
+        # Nothing loaded is garbage yet, collections would only rescan the
+        # growing tree and make loading quadratic
+        gcenabled = gc.isenabled()
+        gc.disable()
+        try:
+            return cls._load(source)
+        finally:
+            if gcenabled:
+                gc.enable()
+
+    @classmethod
+    def _load(cls, source):
+        stack = []
+        unbound = []
+        root = None
+        for action, elem in et.iterparse(source, events=("start", "end")):
+            tag = elem.tag
+            if action == "start":
+                if tag == "execTree":
+                    tree = cls(supertree=stack[-1][0] if stack else None)
+                    tree._load_attrib(elem)
+                    stack.append((tree, []))
+                elif not stack:
+                    raise XMLError("Expect to find execTree in xml.")
+                continue
+            tree, deps = stack[-1]
+            if tag == "execTree":
+                stack.pop()
+                for attrib in deps:
+                    tree._load_dep(attrib)
+                tree.graph_changed()
+                if stack:
+                    stack[-1][0]._add_subtree(tree)
+                else:
+                    root = tree
+            elif tag == "execJob":
+                refs = [
+                    (ref.attrib["uuid"], int(ref.attrib.get("units", 1)))
+                    for ref in elem.iterchildren("execResource")
+                ]
+                job = ExecJob(tree=tree, xml=elem)
+                tree._index_job(job)
+                if len(refs) > len(job.resources):
+                    unbound.append((job, refs))
+            elif tag == "execResource" and elem.getparent().tag == "execTree":
+                ExecResource(tree, xml=elem)
+            elif tag == "execArg" and elem.getparent().tag == "execTree":
+                tree.arguments += (elem.attrib["value"],)
+            elif tag == "execDependency":
+                deps.append(dict(elem.attrib))
+            elif tag == "legendItem":
+                tree._load_legend(elem)
+            else:
+                # Part of a job, loaded with it
+                continue
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+        for job, refs in unbound:
+            for uuidhex, units in refs:
+                resource = job.tree.find_resource(uuidhex)
+                if resource is not None and resource not in job.weights:
+                    job.resources.append(resource)
+                    job.weights[resource] = units
+        return root
+
+    @property
+    def maxparallel(self):
+        """ Max number of job processes of this tree and its subtrees that
+        may run at once, 0 for no limit """
+        return self.limit.limit
+
+    @maxparallel.setter
+    def maxparallel(self, value):
+        self.limit.limit = value
 
     @property
     def cluster_name(self):
@@ -811,16 +1665,21 @@ class ExecTree(object):
         name = self.name.replace(" ", "_")
         return '"cluster_{0}"'.format(name)
 
-    def xml(self):
-        args = {
+    def _xml_args(self):
+        return {
             "version": "1.0",
             "name": self.name,
             "href": self.href,
             "uuid": self.uuid.hex,
             "cwd": self.cwd,
             "waitsuccess": str(self.waitsuccess),
+            "maxparallel": str(self.maxparallel),
         }
-        eti = et.Element("execTree", args)
+
+    def xml(self):
+        eti = et.Element("execTree", self._xml_args())
+        for arg in self.arguments:
+            eti.append(et.Element("execArg", {"value": arg}))
         for job in self.jobs:
             if job.subtree is not None:
                 eti.append(job.subtree.xml())
@@ -832,14 +1691,35 @@ class ExecTree(object):
         for resource in self.resources:
             eti.append(resource.xml())
         for key, value in self.legend.iteritems():
-            eti.append(et.Element("legendItem", {key: value}))
+            eti.append(et.Element("legendItem", {"name": key, "value": value}))
         return eti
 
+    def write(self, target):
+        """ Write xml of the tree to a path or file object, one job at a time
+        instead of building the whole document first, see load() """
+        with et.xmlfile(target, encoding="utf-8") as xf:
+            self._write(xf)
+
+    def _write(self, xf):
+        with xf.element("execTree", self._xml_args()):
+            for arg in self.arguments:
+                xf.write(et.Element("execArg", {"value": arg}))
+            for job in self.jobs:
+                if job.subtree is not None:
+                    job.subtree._write(xf)
+                xf.write(job.xml())
+            for dep in self.deps:
+                xf.write(dep.xml())
+            for resource in self.resources:
+                xf.write(resource.xml())
+            for key, value in self.legend.iteritems():
+                xf.write(et.Element("legendItem", {"name": key, "value": value}))
+
     def __str__(self):
         return "<ExecTree {0}>".format(self.name)
 
     def __getitem__(self, key, default=None):
-        return dict_by_attr(self.jobs, 'name').get(key, default)
+        return self._jobs_by_name.get(key, default)
 
     # These functions added to satisfy pylint complaint about improperly
     # implemented container
@@ -858,66 +1738,125 @@ class ExecTree(object):
         for tree in self.subtrees:
             yield tree
 
+    def root(self):
+        """ Return the outermost supertree, or the tree itself """
+        tree = self
+        while tree.supertree is not None:
+            tree = tree.supertree
+        return tree
+
+    def add_resource(self, resource):
+        """ Add a resource to tree """
+        self.resources.append(resource)
+        self._resources_by_name.setdefault(resource.name, resource)
+        self._resources_by_uuid[resource.uuidhex] = resource
+
     def find_resource(self, needle, default=None):
-        """ Find all resources by uuid or name """
-        for resource in self.resources:
-            if needle in (resource.uuid.hex, resource.name):
-                return resource
-        return default
+        """ Find resource by uuid or name, including those of supertrees """
+        resource = self._resources_by_uuid.get(needle)
+        if resource is None:
+            resource = self._resources_by_name.get(needle)
+        if resource is None and self.supertree is not None:
+            resource = self.supertree.find_resource(needle)
+        if resource is None:
+            return default
+        return resource
 
     def find_subtree(self, uuid, default=None):
-        return dict_by_attr(self.subtrees, 'uuid').get(uuid, default)
+        return self._subtrees_by_uuid.get(getattr(uuid, "hex", uuid), default)
+
+    GLOB_CHARS = re.compile(r"[*?[]")
 
     def find_jobs(self, needle, default=None):
-        """ Find all jobs based on their name / uuid """
-        rval = [
-            n for n in self.jobs
-            if fnmatch.fnmatchcase(n.name, needle) or n.name.uuid.hex == needle
-        ]
+        """ Find all jobs based on their name glob / uuid """
+        if self.GLOB_CHARS.search(needle) is None:
+            job = self.find_job(needle)
+            rval = [job] if job is not None else []
+        else:
+            match = re.compile(fnmatch.translate(needle)).match
+            rval = [job for job in self.jobs if match(job.name)]
         return rval or default or []
 
     def find_job(self, needle, default=None):
         """ Find job based on name or uuid """
-        for job in self.jobs:
-            if needle in (job.name, job.uuid.hex):
-                return job
-        return default
+        job = self._jobs_by_name.get(needle)
+        if job is None:
+            job = self._jobs_by_uuid.get(needle, default)
+        return job
 
     def find_job_deep(self, needle, default=None):
         """ Find job based on name or uuid, looks through subtrees """
-        for tree in self.trees():
-            job = tree.find_job(needle)
-            if job is not None:
-                return job
-        return default
+        job = self.find_job(needle)
+        if job is None:
+            job = self._deep_jobs.get(needle, default)
+        return job
+
+    def _index_deep(self, jobs):
+        """ Make jobs of a subtree known to all our ancestors """
+        tree = self
+        while tree is not None:
+            for job in jobs:
+                tree._deep_jobs.setdefault(job.name, job)
+                tree._deep_jobs.setdefault(job.uuidhex, job)
+            tree = tree.supertree
+
+    def _add_subtree(self, subtree):
+        if subtree.uuid.hex in self._subtrees_by_uuid:
+            return
+        self.subtrees.append(subtree)
+        self._subtrees_by_uuid[subtree.uuid.hex] = subtree
+        subtree.supertree = self
+        self._index_deep(subtree.jobs)
+        self._index_deep(set(subtree._deep_jobs.values()))
+
+    def intern_args(self, args):
+        """ Return args as a tuple shared with all jobs of the tree having
+        the same arguments """
+        args = tuple(args)
+        return self._arguments.setdefault(args, args)
+
+    def colormap(self, defined, undefined):
+        """ Return color map for parents that are defined or not, shared by
+        all dependencies of the tree with the same colors. Replace, do not
+        modify it. """
+        key = (defined, undefined)
+        colors = self._colormaps.get(key)
+        if colors is None:
+            colors = self._colormaps[key] = {
+                "defined": defined, "undefined": undefined
+            }
+        return colors
+
+    def _index_job(self, job):
+        job.arguments = self.intern_args(job.arguments)
+        self.jobs.append(job)
+        self.count_job(job, 1)
+        self._jobs_by_name[job.name] = job
+        self._jobs_by_uuid[job.uuidhex] = job
+        if self.supertree is not None:
+            self.supertree._index_deep([job])
+        if job.subtree is not None:
+            self._add_subtree(job.subtree)
 
     def add_job(self, job):
         """ Add a job to tree"""
-        if self.find_job(job.name):
+        if job.name in self._jobs_by_name:
             raise JobDefinedError(
                 "Job with same name ({0}) already part of tree".format(job)
             )
-        if job.subtree is not None and job.subtree not in self.subtrees:
-            self.subtrees.append(job.subtree)
         job.tree = self
-        self.jobs.append(job)
+        self._index_job(job)
+        self.graph_changed()
 
     def add_dep(self, parent=None, child=None,
                 state=ExecJob.STATE_SUCCESSFULL, xml=None):
         """Add a dependency between 2 jobs that have been previously added
         to tree"""
-        colors = None
         dep = None
         if xml is not None:
             if xml.tag != "execDependency":
                 raise XMLError("Expect to find execDependency in xml.")
-            parent = xml.attrib["parent"]
-            child = xml.attrib["child"]
-            state = int(xml.attrib["state"])
-            colors = {
-                "undefined": xml.attrib["ucolor"],
-                "defined": xml.attrib["dcolor"]
-            }
+            return self._load_dep(xml.attrib)
 
         # Ensure parent and child are ExecJobs
         if not isinstance(parent, ExecJob):
@@ -934,7 +1873,7 @@ class ExecTree(object):
 
         # Parent and Child must be members of the tree
         for k in [child, parent]:
-            if k not in self.jobs:
+            if k.tree is not self:
                 raise JobUndefinedError("Job {0} is not part of the tree: {1}.".format(k.name, self.name))
 
         if parent is child:
@@ -943,12 +1882,12 @@ class ExecTree(object):
         if parent not in child.parents():
             dep = ExecDependency(parent, child, state)
             self.deps.append(dep)
+            self.parent_deps.setdefault(child, []).append(dep)
+            self.child_deps.setdefault(parent, []).append(dep)
+            self.graph_changed()
         else:
             logging.warning("Duplicate dependency.")
 
-        if colors is not None:
-            dep.color = colors
-
         return dep
 
     def argument(self):
@@ -1021,13 +1960,32 @@ class ExecTree(object):
         for job in self.all_jobs_gen():
             status[job.name] = {
                 "status": job.STATE_COLORS[job.state],
-                "progress": job.progress
+                "progress": job.progress,
+                "priority": job.priority,
+                "cached": job.cached
             }
             if job.subtree is not None and job.subtree.iterator is not None:
                 status[job.name]["iteration"] = "{0}/{1}".format(
                     job.subtree.iterator.run,
                     job.subtree.iterator.len()
                 )
+                if job.subtree.instances:
+                    status[job.name]["iterations"] = [
+                        {
+                            "index": index,
+                            "argument": instance.argument(),
+                            "status": job.STATE_COLORS[instance.summary_state()]
+                        }
+                        for index, instance
+                        in sorted(job.subtree.instances.iteritems())
+                    ]
+                if job.subtree.completed:
+                    counts = Counter(job.subtree.completed)
+                    counts.pop(-1, None)
+                    status[job.name]["completed"] = dict(
+                        (job.STATE_COLORS[state], count)
+                        for state, count in counts.iteritems()
+                    )
         return simplejson.dumps(status)
 
     # dot's html map output is: "x,y x,y x,y"
@@ -1046,23 +2004,117 @@ class ExecTree(object):
         with open(json, "w") as jfd:
             jfd.write(self.json_status())
 
+    def graph_changed(self):
+        """ Drop cached graph analysis, called when jobs or deps change """
+        self._analysis = None
+
+    def analysis(self):
+        """
+        Return (anscestors, stems, leaves) of the tree where anscestors is
+        the set of jobs having a defined anscestor.
+
+        Computed in a single pass over the graph and cached until
+        graph_changed() is called.
+        """
+        if self._analysis is None:
+            anscestors = set()
+            queue = deque(job for job in self.jobs if job.is_defined())
+            while queue:
+                job = queue.popleft()
+                for dep in self.child_deps.get(job, ()):
+                    child = dep.child
+                    if child in anscestors:
+                        continue
+                    anscestors.add(child)
+                    # Defined jobs are already queued
+                    if not child.is_defined():
+                        queue.append(child)
+            stems = [
+                job
+                for job in self.jobs
+                if job not in anscestors and job.is_defined()
+            ]
+            leaves = [job for job in self.jobs if self.child_deps.get(job)]
+            self._analysis = (anscestors, stems, leaves)
+        return self._analysis
+
+    def prioritize(self, tail=0, unit=None):
+        """
+        Set priority of every job to the length of the longest path from its
+        start to the end of the tree, so jobs on the critical path are
+        granted limits and resources first. Returns the length of the tree.
+
+        Jobs count for their expected duration, those without one for the
+        mean known duration, or as one hop if no durations are known at all.
+        Subtrees count for their own length times remaining iterations.
+        tail is the length of what follows the tree in its supertree.
+        """
+        if unit is None:
+            known = [
+                job.duration
+                for job in self.all_jobs_gen()
+                if job.duration is not None
+            ]
+            unit = float(sum(known)) / len(known) if known else 1
+        length = {}
+        # Iterative post-order so children are done before their parents,
+        # jobs seen but not done are None which also cuts cycles
+        for root in self.jobs:
+            if root in length:
+                continue
+            length[root] = None
+            work = [(root, iter(self.child_deps.get(root, ())))]
+            while work:
+                job, deps = work[-1]
+                for dep in deps:
+                    if dep.child not in length:
+                        length[dep.child] = None
+                        work.append(
+                            (dep.child, iter(self.child_deps.get(dep.child, ())))
+                        )
+                        break
+                else:
+                    work.pop()
+                    after = max(
+                        [tail] + [
+                            length[dep.child] or 0
+                            for dep in self.child_deps.get(job, ())
+                        ]
+                    )
+                    length[job] = after + self._job_length(job, after, unit)
+        for job, value in length.iteritems():
+            job.priority = value
+        return max([tail] + length.values())
+
+    def _job_length(self, job, tail, unit):
+        if job.subtree is not None:
+            once = job.subtree.prioritize(0, unit)
+            iterator = job.subtree.iterator
+            remaining = 1
+            if iterator is not None:
+                remaining = max(1, iterator.len() - iterator.run)
+            # Jobs of the current iteration are followed by the others
+            job.subtree.prioritize(tail + once * (remaining - 1), unit)
+            return once * remaining
+        if not job.is_defined():
+            return 0
+        if job.duration is not None:
+            return job.duration
+        return unit
+
     def stems(self):
         """
         Finds and returns first job of most unconnected graphs
 
         WARNING This will not find stem of subtrees with cycles
         """
-        return [
-            job
-            for job in self.jobs
-            if not job.has_defined_anscestors() and job.is_defined()
-        ]
+        return list(self.analysis()[1])
 
     def leaves(self):
         """
         Finds and returns all the leaf jobs of a tree
         """
-        return [job for job in self.jobs if job.child_deps()]
+        return list(self.analysis()[2])
 
     def validate(self):
         """ Check that job is i connected DAG, and all jobs are executable """
@@ -1080,11 +2132,18 @@ class ExecTree(object):
                 )
             )
 
+        cycles = self.cycles()
+        cyclic = set(job for cycle in cycles for job in cycle)
+        for cycle in cycles:
+            logging.warning(
+                "Tree {0} has a cycle between jobs {1}."
+                .format(self.name, " ".join([job.name for job in cycle]))
+            )
+
         for stem in stems:
-            visited = []
+            visited = self.reachable(stem)
 
-            cycles = not self.validate_nocycles(stem, visited)
-            if cycles:
+            if not cyclic.isdisjoint(visited):
                 errors.append("Tree {0} has cycles.".format(self.name))
 
             # What jobs are not connected to stem?
@@ -1099,38 +2158,153 @@ class ExecTree(object):
             errors.extend(job.validate())
 
         if self.iterator is not None:
-            if self.iterator.len() < 1:
-                errors.append("Iterator needs at least one argument to run.")
+            errors.extend(self.iterator.validate())
 
         return errors
 
-    def validate_nocycles(self, job, visited, parents=None):
-        """ Ensure we do not have cyclical dependencies in the tree """
-        parents = parents or []
-        if job in parents:
+    def reachable(self, job):
+        """ Return set of jobs reachable from job, job included """
+        visited = set([job])
+        stack = [job]
+        while stack:
+            for dep in self.child_deps.get(stack.pop(), ()):
+                if dep.child not in visited:
+                    visited.add(dep.child)
+                    stack.append(dep.child)
+        return visited
+
+    def cycles(self):
+        """
+        Return list of cyclical dependencies in the tree, each one being the
+        list of jobs part of the cycle.
+
+        Iterative Tarjan strongly connected components, O(jobs + deps).
+        """
+        index = {}
+        lowlink = {}
+        onstack = set()
+        stack = []
+        cycles = []
+        for root in self.jobs:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            onstack.add(root)
+            work = [(root, iter(self.child_deps.get(root, ())))]
+            while work:
+                job, deps = work[-1]
+                for dep in deps:
+                    child = dep.child
+                    if child not in index:
+                        index[child] = lowlink[child] = len(index)
+                        stack.append(child)
+                        onstack.add(child)
+                        work.append((child, iter(self.child_deps.get(child, ()))))
+                        break
+                    elif child in onstack:
+                        lowlink[job] = min(lowlink[job], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[job])
+                    if lowlink[job] == index[job]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            onstack.discard(member)
+                            component.append(member)
+                            if member is job:
+                                break
+                        # Jobs cannot be their own parent, so any cycle
+                        # has at least 2 members
+                        if len(component) > 1:
+                            component.reverse()
+                            cycles.append(component)
+        return cycles
+
+    def job_event(self, job, state):
+        """ Called when job reaches state, queue children that no longer
+        have unfulfilled dependencies """
+        if self.failfast and state == ExecJob.STATE_FAILED:
+            self.cancel()
+        if self._pending is None:
+            return
+        for dep in self.child_deps.get(job, ()):
+            if dep.state != state:
+                continue
+            waiting = self._pending.get(dep.child)
+            if waiting is None:
+                continue
+            waiting.discard(dep)
+            if not waiting:
+                del self._pending[dep.child]
+                self._ready(dep.child)
+        self._drain()
+
+    def _ready(self, job):
+        heapq.heappush(
+            self._readyq, (-job.priority, next(self._readyseq), job)
+        )
+
+    def _drain(self):
+        # Launching undefined jobs fires events right away, unwind them here
+        # rather than recursing through job_event
+        if self._draining:
+            return
+        self._draining = True
+        try:
+            while self._readyq:
+                heapq.heappop(self._readyq)[2].launch()
+        finally:
+            self._draining = False
+
+    def _schedule(self):
+        """ Count unfulfilled dependencies of each job and launch those
+        which have none """
+        self._pending = {}
+        for job in self.jobs:
+            # Using STATE_SUCCESSFULL for the same reason start() does
+            if job.state == job.STATE_SUCCESSFULL:
+                continue
+            waiting = set(
+                dep
+                for dep in self.parent_deps.get(job, ())
+                if not dep.is_fulfilled()
+            )
+            if waiting:
+                self._pending[job] = waiting
+            else:
+                self._ready(job)
+        self._drain()
+
+    def count_job(self, job, sign):
+        """ Add (sign=1) or remove (sign=-1) job from completion counters """
+        if job.mustcomplete:
+            self._must_total += sign
+            if job.is_done():
+                self._must_done += sign
+            if job.is_success():
+                self._must_success += sign
+
+    def _complete(self):
+        if self._must_done < self._must_total:
             return False
-        parents.append(job)
-        if job not in visited:
-            visited.append(job)
-        for child in job.children():
-            if not self.validate_nocycles(child, visited, parents):
-                return False
-        parents.remove(job)
+        if not self.cancelled and self.waitsuccess:
+            return self._must_success >= self._must_total
         return True
 
-    def _is_done_event(self, instance):
-        self.is_done()
+    def check_done(self):
+        """ Called on job state change, fires done_event once the last job
+        the tree is waiting for finishes """
+        if self.started and self._complete():
+            self.is_done()
 
     def is_done(self):
         """ True if all jobs in tree have completed execution """
-        for job in self.jobs:
-            if job.mustcomplete:
-                if (not self.cancelled and self.waitsuccess and not job.is_success()):
-                    logging.debug("{0} is not successfull".format(job.name))
-                    return False
-                if not job.is_done():
-                    logging.debug("{0} is not done".format(job.name))
-                    return False
+        if not self._complete():
+            return False
         self.done_event.set()
         self.cancel()
         self.done = True
@@ -1144,6 +2318,19 @@ class ExecTree(object):
         """ True if all the jobs in tree have successfully executed """
         return all(job.is_success() for job in self.jobs)
 
+    def summary_state(self):
+        """ Return the job state that best describes the tree as a whole """
+        states = set(job.state for job in self.jobs)
+        for state in [
+            ExecJob.STATE_RUNNING, ExecJob.STATE_FAILED,
+            ExecJob.STATE_BLOCKED, ExecJob.STATE_CANCELLED
+        ]:
+            if state in states:
+                return state
+        if self.is_success():
+            return ExecJob.STATE_SUCCESSFULL
+        return ExecJob.STATE_IDLE
+
     def cancel(self):
         # TODO break cancel into cancel and abort, cancel should be called externally we do want to kill off jobs without leaving cancel metadata all over the place
         # TODO if canceling a subtree of a running parent .. we need to fail else we will have to wait 'till execution timeout
@@ -1158,6 +2345,8 @@ class ExecTree(object):
             job.cancel()
         for tree in self.subtrees:
             tree.cancel()
+        for tree in self.instances.values():
+            tree.cancel()
         self.is_done()
 
     def run(self, blocking=True, timeout=None):
@@ -1166,19 +2355,19 @@ class ExecTree(object):
             logging.debug("Its cancelled already")
             return
         logging.debug("About to spin up jobs for {0}".format(self.name))
-        for job in self.jobs:
-            for ev in job.events.values():
-                ev.rawlink(self._is_done_event)
-            job.start()
+        if self.readyqueue:
+            self._schedule()
+        else:
+            for job in self.jobs:
+                job.start()
         self.started = True
+        self.check_done()
         if blocking:
             with gevent.Timeout(timeout) as timeout:
                 try:
-                    logging.debug("Jobs have been spun up for {0}. I'm gonna chill".format(self.name))
-                    gevent.sleep(1)
                     logging.debug(
-                        "Chilling is done. Impatiently waiting for jobs of"
-                        "{0} to finish".format(self.name)
+                        "Jobs have been spun up. Impatiently waiting for jobs"
+                        " of {0} to finish".format(self.name)
                     )
                     self.join()
                     logging.debug("Tree {0} has finished execution.".format(self.name))
@@ -1201,6 +2390,25 @@ class ExecTree(object):
         """Setup greenlet which automatically updates json file"""
         Greenlet.spawn(self._json_updater, path)
 
+    def inherited(self, name):
+        """ Return attribute name of the tree or of its closest supertree
+        where it is not None """
+        tree = self
+        while tree is not None:
+            value = getattr(tree, name)
+            if value is not None:
+                return value
+            tree = tree.supertree
+        return None
+
+    def record(self, event, **fields):
+        """ Add event of this tree to the journal of the tree or its closest
+        supertree that has one """
+        journal = self.inherited("journal")
+        if journal is not None:
+            fields.setdefault("tree", self.name)
+            journal.record(event, **fields)
+
     def advance(self):
         """ Advance iterator to next tree argument """
         logging.debug("Advancing tree {0}.".format(self.name))
@@ -1208,6 +2416,7 @@ class ExecTree(object):
         self.cancelled = False
         if self.iterator is not None:
             inc = self.iterator.increment()
+            self.record("iteration", run=self.iterator.run)
         else:
             inc = True
         if inc:
@@ -1223,6 +2432,8 @@ class ExecTree(object):
         if self.iterator.is_exhausted():
             logging.debug("Iterator is exhausted")
             return False
+        if self.iterator.parallel > 1:
+            return self._iterrun_parallel()
         while True:
             self.run()
             if not self.is_success():
@@ -1232,13 +2443,149 @@ class ExecTree(object):
             if self.iterator.is_exhausted():
                 break
 
+    def clone(self, argument=None, waitsuccess=None):
+        """
+        Return a copy of the tree with its own jobs and states, iterating
+        over argument only if it is set. Resources, limits and priorities
+        are shared with the original.
+        """
+        if waitsuccess is None:
+            waitsuccess = self.waitsuccess
+        tree = ExecTree()
+        tree.name = self.name
+        tree.href = self.href
+        tree.cwd = self.cwd
+        tree.waitsuccess = waitsuccess
+        tree.limit = self.limit
+        tree.resource_queue = self.resource_queue
+        tree.resultcache = self.resultcache
+        tree.upstream = self.upstream
+        tree.legend = self.legend
+        tree._arguments = self._arguments
+        tree.arguments = self.arguments
+        tree.volatile = self.volatile
+        if argument is not None:
+            tree.iterator = ExecIter(self.iterator.name, [argument])
+        elif self.iterator is not None:
+            tree.iterator = self.iterator.copy()
+        for job in self.jobs:
+            subtree = None
+            if job.subtree is not None:
+                subtree = job.subtree.clone(waitsuccess=waitsuccess)
+            copy = ExecJob(
+                job.name,
+                job.jobpath,
+                logfile=job.logfile,
+                mustcomplete=job.mustcomplete,
+                subtree=subtree,
+                arguments=job.arguments,
+                resources=list(job.resources),
+                href=job.href,
+                tcolor=job.tcolor,
+                limit=job.limit,
+                duration=job.duration,
+                weights=dict(job.weights),
+                barrier=job.barrier,
+            )
+            copy.priority = job.priority
+            copy.template = job
+            tree.add_job(copy)
+        for dep in self.deps:
+            copy = tree.add_dep(dep.parent.name, dep.child.name, dep.state)
+            copy.color = dep.color
+        # Only linked up for limits, the supertree does not know the copy
+        tree.supertree = self.supertree
+        return tree
+
+    def _iterrun_parallel(self):
+        """
+        Run up to iterator.parallel iterations at once, each in a copy of the
+        tree. No new iterations are started once one fails, those that
+        succeeded are skipped when the tree is run again. Our own jobs end
+        up failed if any of their copies failed, successful if all of them
+        succeeded and cancelled otherwise. Copies that succeeded are dropped
+        once done, leaving their summary state in completed.
+
+        Copies do not wait for failed jobs to be rescheduled, a copy is
+        cancelled as soon as one of its jobs fails and the job of the subtree
+        is rescheduled instead. A failing iterator command is raised once the
+        started iterations are done.
+        """
+        iterator = self.iterator
+        pool = gevent.pool.Pool(iterator.parallel)
+        self.instances = {}
+        failed = []
+        error = None
+
+        def run_instance(index, instance):
+            instance.run()
+            self._complete_iteration(index, instance.summary_state())
+            if instance.is_success():
+                del self.instances[index]
+                iterator.finish(index)
+                self.record("iteration", index=index)
+            else:
+                failed.append(index)
+
+        try:
+            for index, argument in iterator.pending():
+                pool.wait_available()
+                if failed or self.cancelled:
+                    break
+                instance = self.clone(argument, waitsuccess=False)
+                instance.failfast = True
+                self.instances[index] = instance
+                pool.spawn(run_instance, index, instance)
+        except subprocess.CalledProcessError, ex:
+            error = ex
+        pool.join()
+
+        for job in self.jobs:
+            if not job.is_defined():
+                continue
+            copies = [
+                instance.find_job(job.name)
+                for instance in self.instances.values()
+            ]
+            if any(copy.is_failed() for copy in copies):
+                job.state = job.STATE_FAILED
+            elif all(copy.is_success() for copy in copies):
+                job.state = job.STATE_SUCCESSFULL
+            else:
+                job.state = job.STATE_CANCELLED
+        if error is not None:
+            raise error
+        return not failed
+
+    def _complete_iteration(self, index, state):
+        missing = index + 1 - len(self.completed)
+        if missing > 0:
+            self.completed.extend([-1] * missing)
+        self.completed[index] = state
+
     def join(self):
         """Wait for tree completion"""
         self.done_event.wait()
 
-    def extend_args(self, args):
-        """Set iterated argument for all jobs for this iteration"""
-        for job in self.jobs:
-            job.arguments.extend(args)
-        for subtree in self.subtrees:
-            subtree.extend_args(args)
+    def extend_args(self, args, volatile=False):
+        """Add arguments passed to all jobs of the tree and its subtrees.
+
+        They are stored once on the tree and resolved when jobs are launched,
+        see ExecJob.argv(). Volatile arguments change from run to run without
+        changing what a job does, they are passed after all other arguments
+        and are not part of job fingerprints.
+        """
+        if volatile:
+            self.volatile += tuple(args)
+        else:
+            self.arguments += tuple(args)
+
+    def tree_args(self, volatile=False):
+        """ Return arguments added to the tree and its supertrees by
+        extend_args(), outermost tree first """
+        args = ()
+        tree = self
+        while tree is not None:
+            args = (tree.volatile if volatile else tree.arguments) + args
+            tree = tree.supertree
+        return args
@@ -0,0 +1,258 @@
+#!/usr/bin/python
+# vim: ts=4 et sts filetype=python
+# This file is part of RCubic
+#
+# Copyright (c) 2012 Wireless Generation, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Scaling benchmarks for ExecTree.
+
+Not collected by the test runner, run directly:
+
+    python tests/bench_exectree.py [bench ...]
+
+Each benchmark is run against increasing graph sizes. Time per element
+should stay roughly flat if the operation scales linearly.
+"""
+
+from __future__ import print_function
+
+import gc
+import io
+import os
+import resource
+import sys
+import time
+
+from lxml import etree
+
+from RCubic import exectree
+
+SIZES = (500, 1000, 2000, 4000)
+
+
+def _rss():
+    """Resident memory of the process in bytes"""
+    try:
+        with open("/proc/self/statm") as fd:
+            return int(fd.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _timed(func, *args):
+    start = time.time()
+    rval = func(*args)
+    return time.time() - start, rval
+
+
+def _new_tree(size, every=0):
+    """Tree of undefined jobs, every n-th job is defined instead"""
+    tree = exectree.ExecTree()
+    tree.name = "bench"
+    jobs = [
+        exectree.ExecJob(
+            "job{0}".format(i),
+            "/bin/true" if every and i % every == 0 else "-"
+        )
+        for i in range(size)
+    ]
+    for job in jobs:
+        tree.add_job(job)
+    return tree, jobs
+
+
+def _add_deps(tree, jobs):
+    """First job fans out to chains of 10 jobs, with some cross links"""
+    for i, job in enumerate(jobs[1:], 1):
+        if i % 10 == 1:
+            tree.add_dep(jobs[0], job)
+        else:
+            tree.add_dep(jobs[i - 1], job)
+        if i > 20 and i % 7 == 0:
+            tree.add_dep(jobs[i - 20], job)
+
+
+def _neighbours(tree, jobs):
+    for job in jobs:
+        job.parents()
+        job.children()
+        job.orphan()
+    tree.leaves()
+
+
+def _find(tree, jobs):
+    for job in jobs:
+        tree.find_job(job.name)
+        tree.find_job_deep(job.uuid.hex)
+
+
+def bench_deps():
+    """Tree build and lookups"""
+    for size in SIZES:
+        add_job, (tree, jobs) = _timed(_new_tree, size)
+        build, _ = _timed(_add_deps, tree, jobs)
+        lookup, _ = _timed(_neighbours, tree, jobs)
+        find, _ = _timed(_find, tree, jobs)
+        edges = len(tree.deps)
+        yield size, [
+            ("add_job", add_job, size),
+            ("add_dep", build, edges),
+            ("lookups", lookup, size),
+            ("find_job", find, size),
+        ]
+
+
+def _add_diamonds(tree, jobs):
+    """Ladder of diamonds"""
+    for i, job in enumerate(jobs):
+        if i >= 2:
+            tree.add_dep(jobs[i - 2], job)
+        if i >= 3 and i % 2 == 1:
+            tree.add_dep(jobs[i - 3], job)
+
+
+def bench_analysis():
+    """Stem and anscestor analysis on diamond ladders"""
+    for size in SIZES:
+        tree, jobs = _new_tree(size, every=4)
+        _add_diamonds(tree, jobs)
+        stems, _ = _timed(tree.stems)
+        cached, _ = _timed(tree.stems)
+        yield size, [
+            ("stems", stems, size),
+            ("cached", cached, size),
+        ]
+
+
+def bench_validate():
+    """Cycle and connectivity validation"""
+    for size in SIZES:
+        tree, jobs = _new_tree(size, every=1)
+        _add_deps(tree, jobs)
+        validate, _ = _timed(tree.validate)
+        yield size, [("validate", validate, size + len(tree.deps))]
+
+
+def _write(tree):
+    out = io.BytesIO()
+    tree.write(out)
+    return out.getvalue()
+
+
+def bench_xml():
+    """Streaming xml save and load against the in memory round trip"""
+    for size in SIZES:
+        tree, jobs = _new_tree(size, every=1)
+        _add_deps(tree, jobs)
+        elems = size + len(tree.deps)
+        tostring, doc = _timed(lambda: etree.tostring(tree.xml()))
+        fromstring, _ = _timed(lambda: exectree.ExecTree(etree.fromstring(doc)))
+        write, doc = _timed(_write, tree)
+        load, _ = _timed(exectree.ExecTree.load, io.BytesIO(doc))
+        yield size, [
+            ("tostring", tostring, elems),
+            ("write", write, elems),
+            ("fromstring", fromstring, elems),
+            ("load", load, elems),
+        ]
+
+
+CHAIN_SIZES = (25, 50, 100, 200)
+
+
+def bench_chain():
+    """End to end latency of chains of no-op jobs"""
+    for size in CHAIN_SIZES:
+        tree = exectree.ExecTree()
+        tree.name = "chain"
+        parent = None
+        for i in range(size):
+            job = exectree.ExecJob("job{0}".format(i), "/bin/true")
+            job.logfile = "/dev/null"
+            tree.add_job(job)
+            if parent is not None:
+                tree.add_dep(parent, job)
+            parent = job
+        run, _ = _timed(tree.run)
+        yield size, [("run", run, size)]
+
+
+MEMORY_SIZES = (5000, 10000, 20000, 40000)
+
+
+def bench_memory():
+    """Resident memory of jobs and dependencies"""
+    for size in MEMORY_SIZES:
+        gc.collect()
+        base = _rss()
+        tree = exectree.ExecTree()
+        jobs = []
+        for i in range(size):
+            job = exectree.ExecJob(
+                "job{0}".format(i), "/bin/true", arguments=["1.0"]
+            )
+            tree.add_job(job)
+            jobs.append(job)
+        tree.extend_args(["production"])
+        tree.extend_args(["8080", "8080"], volatile=True)
+        gc.collect()
+        job_bytes = _rss() - base
+        _add_deps(tree, jobs)
+        gc.collect()
+        dep_bytes = _rss() - base - job_bytes
+        yield size, [
+            ("job", job_bytes / 1e6, size),
+            ("edge", dep_bytes / 1e6, len(tree.deps)),
+        ]
+        del tree, jobs, job
+
+
+# Reported as MB and bytes per element instead of seconds and us
+bench_memory.units = ("MB", "B")
+
+
+BENCHMARKS = {
+    "deps": bench_deps,
+    "analysis": bench_analysis,
+    "validate": bench_validate,
+    "chain": bench_chain,
+    "xml": bench_xml,
+    "memory": bench_memory,
+}
+
+
+def main(names):
+    for name in names or sorted(BENCHMARKS):
+        bench = BENCHMARKS[name]
+        print("{0}: {1}".format(name, bench.__doc__))
+        total, per = getattr(bench, "units", ("s", "us"))
+        for size, results in bench():
+            for label, value, count in results:
+                print(
+                    "  {0:>7} {1:<10} {2:8.3f}{4} {3:8.2f}{5}/elem".format(
+                        size, label, value, value * 1e6 / max(count, 1),
+                        total, per
+                    )
+                )
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# vim: ts=4 et sts filetype=python
+# This file is part of RCubic
+#
+# Copyright (c) 2012 Wireless Generation, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from RCubic import exectree
+from RCubic.execjournal import ExecJournal
+import unittest
+import shutil
+import tempfile
+import gevent
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="rcj")
+        self.path = "{0}/journal.jsonl".format(self.workdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, False)
+
+    def _tree(self, failing=False):
+        """ foo -> bar -> baz, bar fails if failing """
+        tree = exectree.ExecTree()
+        tree.name = "journal"
+        jobs = [
+            exectree.ExecJob("foo", "/bin/true"),
+            exectree.ExecJob("bar", "/bin/false" if failing else "/bin/true"),
+            exectree.ExecJob("baz", "/bin/true"),
+        ]
+        for job in jobs:
+            tree.add_job(job)
+        tree.add_dep(jobs[0], jobs[1])
+        tree.add_dep(jobs[1], jobs[2])
+        return tree, jobs
+
+    def test_resume(self):
+        """Successful jobs are skipped when resuming"""
+        tree, jobs = self._tree(failing=True)
+        tree.journal = ExecJournal(self.path, interval=0.01)
+        tree.journal.record("start", githead="abc")
+        with gevent.Timeout(10):
+            tree.run(blocking=False)
+            jobs[1].events[jobs[1].STATE_FAILED].wait()
+        tree.journal.close()
+
+        # Torn record from a crash mid write
+        with open(self.path, "a") as fd:
+            fd.write('{"event": "job", "tr')
+
+        state = ExecJournal.replay(self.path)
+        self.assertEqual(state.header["githead"], "abc")
+        tree, jobs = self._tree()
+        self.assertEqual(state.restore(tree), 1)
+        self.assertTrue(jobs[0].is_success())
+        self.assertEqual(jobs[1].state, jobs[1].STATE_IDLE)
+        with gevent.Timeout(10):
+            tree.run()
+        self.assertTrue(tree.is_success())
+        self.assertEqual([job.execcount for job in jobs], [0, 1, 1])
+
+    def test_resume_handlers(self):
+        """Restored jobs do not call their event handlers again"""
+        tree, jobs = self._tree(failing=True)
+        tree.journal = ExecJournal(self.path, interval=0.01)
+        with gevent.Timeout(10):
+            tree.run(blocking=False)
+            jobs[1].events[jobs[1].STATE_FAILED].wait()
+        tree.journal.close()
+
+        tree, jobs = self._tree()
+        calls = dict((job.name, []) for job in jobs)
+        for job in jobs:
+            for state in [job.STATE_RUNNING] + job.DONE_STATES:
+                job.events[state].rawlink(
+                    lambda event, job=job: calls[job.name].append(job.state)
+                )
+        ExecJournal.replay(self.path).restore(tree)
+        with gevent.Timeout(10):
+            tree.run()
+        gevent.sleep(0.01)
+        self.assertEqual(calls["foo"], [])
+        self.assertEqual(len(calls["bar"]), 2)
+        self.assertEqual(len(calls["baz"]), 2)
+
+        # Rescheduled children do not wait on events of restored parents
+        jobs[1].reset()
+        with gevent.Timeout(10):
+            jobs[1].start()
+            jobs[1].events[jobs[1].STATE_SUCCESSFULL].wait()
+
+    def test_iteration(self):
+        """Iterated subtrees continue where they were"""
+        ltree = exectree.ExecTree()
+        ltree.name = "loop"
+        ltree.add_job(exectree.ExecJob("sal", "/bin/true"))
+        ltree.iterator = exectree.ExecIter("it", ["a", "b", "c"])
+        tree, jobs = self._tree()
+        job = exectree.ExecJob("sym", subtree=ltree)
+        tree.add_job(job)
+        tree.add_dep(jobs[2], job)
+        tree.journal = ExecJournal(self.path, interval=0.01)
+        with gevent.Timeout(10):
+            tree.run()
+        tree.journal.close()
+
+        state = ExecJournal.replay(self.path)
+        self.assertEqual(state.iterations["loop"][0], 3)
+        ltree.iterator = exectree.ExecIter("it", ["a", "b", "c", "d"])
+        state.restore(tree)
+        self.assertEqual(ltree.iterator.run, 3)
+        self.assertEqual(ltree.iterator.argument, "d")
+
+
+if __name__ == '__main__':
+    unittest.main()
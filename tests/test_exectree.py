@@ -22,7 +22,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from RCubic import exectree
+from RCubic import exectree, RCubicUtilities
 import unittest
 import pydot
 from lxml import etree
@@ -35,6 +35,21 @@ import time
 import gevent
 import logging
 import functools
+import simplejson
+import io
+import subprocess
+import weakref
+import gc
+
+
+class ResultCache(dict):
+    """ Fingerprints of successful jobs kept in memory """
+
+    def hasFingerprint(self, fingerprint):
+        return fingerprint in self
+
+    def saveFingerprint(self, fingerprint, job):
+        self[fingerprint] = job
 
 
 class TestET(unittest.TestCase):
@@ -141,6 +156,31 @@ class TestET(unittest.TestCase):
         self.assertTrue(job6 in stems)
         self.assertNotEqual(self.tree.validate(), [])
 
+    def test_adjacency(self):
+        """Parent and child lookups"""
+        job4 = self._newjob("fiz", self.tree)
+        self.tree.add_dep(self.job2, job4)
+        self.tree.add_dep(self.job3, job4)
+        self.assertEqual(self.job1.children(), [self.job2, self.job3])
+        self.assertEqual(job4.parents(), [self.job2, self.job3])
+        self.assertEqual(job4.children(), [])
+        self.assertTrue(self.job1.orphan())
+        self.assertFalse(job4.orphan())
+        self.assertIsNone(self.tree.add_dep(self.job2, job4))
+        self.assertEqual(len(self.tree.deps), 4)
+
+    def test_stems_invalidation(self):
+        """Stems follow graph and job definition changes"""
+        self.assertEqual(self.tree.stems(), [self.job1])
+        job4 = self._newjob("fiz", self.tree)
+        self.assertEqual(self.tree.stems(), [self.job1, job4])
+        self.tree.add_dep(self.job3, job4)
+        self.assertEqual(self.tree.stems(), [self.job1])
+        self.assertTrue(job4.has_defined_anscestors())
+        self.job1.jobpath = self.job1.UNDEF_JOB
+        self.assertEqual(self.tree.stems(), [self.job2, self.job3])
+        self.assertFalse(self.job2.has_defined_anscestors())
+
     def test_own_parent(self):
         """Detect bootstrap paradox"""
         self.assertRaises(
@@ -157,6 +197,30 @@ class TestET(unittest.TestCase):
         # logging.debug("stems: {0}".format([stem.name for stem in stems]))
         self.assertNotEqual(self.tree.validate(), [])
 
+    def test_cycle_members(self):
+        """Cycle detection reports jobs part of each cycle"""
+        job4 = self._newjob("fiz", self.tree)
+        self.tree.add_dep(self.job3, job4)
+        self.tree.add_dep(job4, self.job3)
+        self.tree.add_dep(self.job1, job4)
+        self.assertEqual(self.tree.cycles(), [[self.job3, job4]])
+        self.assertTrue(
+            "Tree {0} has cycles.".format(self.tree.name)
+            in self.tree.validate()
+        )
+
+    def test_deep_validation(self):
+        """Validate chains deeper than the recursion limit"""
+        parent = self.job3
+        for i in range(3000):
+            job = exectree.ExecJob("deep{0}".format(i), "/bin/true")
+            self.tree.add_job(job)
+            self.tree.add_dep(parent, job)
+            parent = job
+        self.assertEqual(self.tree.validate(), [])
+        self.tree.add_dep(parent, self.job3)
+        self.assertEqual(len(self.tree.cycles()[0]), 3001)
+
     def test_validation(self, tree=None):
         """Validate a tree"""
         if tree is None:
@@ -198,6 +262,112 @@ class TestET(unittest.TestCase):
         )
         self.assertEqual(xmlstr1, xmlstr2)
 
+    def test_xml_subtree(self):
+        """xml round trip keeps legend and resources used by subtrees"""
+        resource = exectree.ExecResource(self.tree, "res", 2)
+        subtree = exectree.ExecTree()
+        subtree.name = "sub"
+        job4 = self._newjob("qor", subtree)
+        job4.resources.append(resource)
+        job4.weights[resource] = 2
+        job5 = exectree.ExecJob("qam", subtree=subtree)
+        self.tree.add_job(job5)
+        self.tree.add_dep(self.job3, job5)
+        self.tree.legend["version"] = "1.0"
+        self.test_xml()
+
+        self.test_xml_stream()
+
+        for tree in [
+            exectree.ExecTree(self.tree.xml()),
+            exectree.ExecTree.load(io.BytesIO(etree.tostring(self.tree.xml())))
+        ]:
+            self.assertEqual(tree.legend, {"version": "1.0"})
+            job = tree.find_job_deep(job4.uuid.hex)
+            self.assertEqual(job.resources, [tree.find_resource("res")])
+            self.assertEqual(job.resource_units(), {tree.find_resource("res"): 2})
+
+    def test_xml_stream(self):
+        """Streaming write and load match xml()"""
+        xmlstr = etree.tostring(self.tree.xml())
+        out = io.BytesIO()
+        self.tree.write(out)
+        self.assertEqual(out.getvalue(), xmlstr)
+
+        tree = exectree.ExecTree.load(io.BytesIO(xmlstr))
+        self.assertEqual(etree.tostring(tree.xml()), xmlstr)
+        self.assertEqual(len(tree.deps), len(self.tree.deps))
+        self.assertRaises(
+            exectree.XMLError, exectree.ExecTree.load, io.BytesIO("<foo/>")
+        )
+
+    def test_barrier(self):
+        """Barrier jobs survive xml and are drawn as points"""
+        barrier = exectree.ExecJob("PHASE_EARLY", "-", barrier=True)
+        self.tree.add_job(barrier)
+        self.tree.add_dep(self.job2, barrier)
+        self.tree.add_dep(self.job3, barrier)
+        self.test_xml()
+
+        tree = exectree.ExecTree.load(io.BytesIO(etree.tostring(self.tree.xml())))
+        self.assertTrue(tree.find_job("PHASE_EARLY").barrier)
+        self.assertFalse(tree.find_job("foo").barrier)
+        node = barrier._dot_node("sans-serif")
+        self.assertEqual(node.get_shape(), "point")
+
+    def test_tree_args(self):
+        """Tree arguments are resolved at launch and survive xml"""
+        subtree = exectree.ExecTree()
+        subtree.name = "sub"
+        job4 = exectree.ExecJob("qor", "/bin/true", arguments=["1.0"])
+        subtree.add_job(job4)
+        self.tree.add_job(exectree.ExecJob("qam", subtree=subtree))
+        self.tree.extend_args(["prod"])
+        self.tree.extend_args(["8080"], volatile=True)
+        subtree.extend_args(["sub"])
+        self.assertEqual(job4.arguments, ("1.0",))
+        self.assertEqual(
+            job4.argv(), ["/bin/true", "1.0", "prod", "sub", "8080"]
+        )
+        self.assertEqual(
+            self.job1.argv(),
+            [self.job1.jobpath] + list(self.job1.arguments) + ["prod", "8080"]
+        )
+
+        for tree in [
+            exectree.ExecTree(self.tree.xml()),
+            exectree.ExecTree.load(io.BytesIO(etree.tostring(self.tree.xml())))
+        ]:
+            job = tree.find_job_deep(job4.uuidhex)
+            self.assertEqual(job.argv(), ["/bin/true", "1.0", "prod", "sub"])
+        self.assertEqual(
+            subtree.clone().find_job("qor").argv(), job4.argv()
+        )
+
+    def test_intern(self):
+        """Jobs of a tree share argument tuples and color maps"""
+        job4 = exectree.ExecJob("qor", "/bin/true", arguments=["1.0"])
+        job5 = exectree.ExecJob("qam", "/bin/true", arguments=["1.0"])
+        self.tree.add_job(job4)
+        self.tree.add_job(job5)
+        self.assertTrue(job4.arguments is job5.arguments)
+        self.assertTrue(
+            self.tree.clone().find_job("qor").arguments is job4.arguments
+        )
+        colors = self.tree.colormap("red", "gold2")
+        self.assertTrue(self.tree.colormap("red", "gold2") is colors)
+
+        # Nothing is kept once the tree is gone
+        tree = exectree.ExecTree()
+        job6 = exectree.ExecJob("qux", "/bin/true", arguments=["1.0"])
+        tree.add_job(job6)
+        self.assertFalse(job6.arguments is job4.arguments)
+        self.assertFalse(tree.colormap("red", "gold2") is colors)
+        ref = weakref.ref(tree)
+        del tree, job6
+        gc.collect()
+        self.assertTrue(ref() is None)
+
     def test_execjob_nofile(self):
         """Validates error on no job file"""
         self.assertEqual(self.tree.validate(), [])
@@ -258,6 +428,36 @@ class TestET(unittest.TestCase):
         self.assertTrue(ltree.is_done())
         self.assertTrue(self.tree.is_done())
 
+    def test_lookup(self):
+        """Job, resource and nested subtree lookups"""
+        ltree = exectree.ExecTree()
+        ljob1 = self._newjob("yup", ltree)
+        job4 = exectree.ExecJob("rez", subtree=ltree)
+        self.tree.add_job(job4)
+        # Nested subtree populated after being attached
+        nltree = exectree.ExecTree()
+        ltree.add_job(exectree.ExecJob("yak", subtree=nltree))
+        njob1 = self._newjob("yol", nltree)
+
+        self.assertIs(self.tree.find_job(self.job2.uuid.hex), self.job2)
+        self.assertIs(self.tree["bar"], self.job2)
+        self.assertIsNone(self.tree.find_job("yup"))
+        self.assertIs(self.tree.find_job_deep("yup"), ljob1)
+        self.assertIs(self.tree.find_job_deep("yol"), njob1)
+        self.assertIs(self.tree.find_job_deep(njob1.uuid.hex), njob1)
+        self.assertIs(self.tree.find_subtree(ltree.uuid), ltree)
+        self.assertEqual(self.tree.find_jobs("ba?"), [self.job2, self.job3])
+        self.assertEqual(self.tree.find_jobs(self.job1.uuid.hex), [self.job1])
+        self.assertEqual(self.tree.find_jobs("nope"), [])
+
+        resource = exectree.ExecResource(self.tree, "r1", 1)
+        self.assertIs(self.tree.find_resource("r1"), resource)
+        self.assertIs(self.tree.find_resource(resource.uuid.hex), resource)
+        self.assertRaises(
+            exectree.JobDefinedError,
+            self.tree.add_job, exectree.ExecJob("foo", "-")
+        )
+
     def test_crosstree_dep(self):
         """Detect dependencies between jobs in different trees"""
         ltree = exectree.ExecTree()
@@ -271,6 +471,31 @@ class TestET(unittest.TestCase):
             self.tree.run()
         self.assertTrue(self.tree.is_done())
 
+    def test_chain_latency(self):
+        """Children start as soon as their parent exits"""
+        parent = self.job3
+        for i in range(20):
+            job = self._newjob("cha{0}".format(i), self.tree, maxsleep=0)
+            self.tree.add_dep(parent, job)
+            parent = job
+        for job in [self.job1, self.job2, self.job3]:
+            job.jobpath = "/bin/true"
+        start = time.time()
+        with gevent.Timeout(10):
+            self.tree.run()
+        self.assertTrue(self.tree.is_success())
+        self.assertTrue(time.time() - start < 5)
+
+    def test_wait_child(self):
+        """Children are reaped as soon as SIGCHLD is delivered"""
+        p = subprocess.Popen(["sleep", "3"])
+        start = time.time()
+        # As the SIGCHLD handler would, polling alone waits until 4.1s
+        gevent.spawn_later(3.1, RCubicUtilities._childExited)
+        with gevent.Timeout(10):
+            self.assertEqual(RCubicUtilities.waitChild(p, maxdelay=30), 0)
+        self.assertTrue(time.time() - start < 3.8)
+
     def test_incomplete_tree(self):
         """Run tree with failed and sans mustcomplete jobs"""
         job4 = self._newjob("war", self.tree, exitcode=1, maxsleep=0)
@@ -294,6 +519,50 @@ class TestET(unittest.TestCase):
         self.assertTrue(job6.is_done())
         self.assertTrue(self.tree.is_done())
 
+    def test_done_counters(self):
+        """Tree completion follows job state and mustcomplete changes"""
+        self.tree.waitsuccess = True
+        self.tree.started = True
+        job4 = self._newjob("war", self.tree)
+        job4.mustcomplete = False
+        self.job1.state = self.job1.STATE_SUCCESSFULL
+        self.job2.state = self.job2.STATE_FAILED
+        self.job3.state = self.job3.STATE_SUCCESSFULL
+        self.assertFalse(self.tree.done_event.is_set())
+        self.assertFalse(self.tree.is_done())
+        self.job2.state = self.job2.STATE_SUCCESSFULL
+        self.assertTrue(self.tree.done_event.is_set())
+        self.assertTrue(job4.is_cancelled())
+
+        self.tree.advance()
+        self.assertFalse(self.tree.is_done())
+        self.tree.waitsuccess = False
+        for job in [self.job1, self.job2]:
+            job.state = job.STATE_FAILED
+        self.assertFalse(self.tree.done_event.is_set())
+        self.job3.mustcomplete = False
+        self.assertTrue(self.tree.done_event.is_set())
+
+    def test_legacy_scheduler(self):
+        """Run tree with a waiting greenlet per job"""
+        self.tree.readyqueue = False
+        self.test_incomplete_tree()
+
+    def test_ready_queue(self):
+        """Only jobs whose dependencies are fulfilled get launched"""
+        job4 = self._newjob("wop", self.tree, maxsleep=0)
+        self.tree.add_dep(self.job2, job4)
+        self.tree.add_dep(self.job3, job4)
+        with gevent.Timeout(10):
+            self.tree.run(blocking=False)
+            self.assertEqual(
+                sorted(job.name for job in self.tree._pending),
+                ["bar", "baz", "wop"]
+            )
+            self.tree.join()
+        self.assertEqual(self.tree._pending, {})
+        self.assertTrue(job4.is_success())
+
     def _test_treetarator_init(self):
         """Set up iterated tree for testing"""
         self.ltree = exectree.ExecTree()
@@ -401,6 +670,199 @@ class TestET(unittest.TestCase):
         self.assertTrue(self.ljob_undef.state == self.ljob_undef.STATE_UNDEF)
 
 
+    def test_treetarator_parallel(self):
+        """Run iterations of a subtree at the same time"""
+        self._test_treetarator_init()
+        self.ltree.iterator.parallel = 3
+        samples = []
+        sampler = gevent.spawn(self._sample_used, self.tree.limit, samples)
+        self.tree.maxparallel = 3
+
+        with gevent.Timeout(30):
+            self.tree.run()
+        sampler.kill()
+
+        self.assertTrue(self.tree.is_success())
+        self.assertTrue(max(samples) <= 3)
+        self.assertEqual(self.ljob1_count, 1)
+        # Successful copies are not kept
+        self.assertEqual(self.ltree.instances, {})
+        self.assertEqual(
+            list(self.ltree.completed), [self.ljob1.STATE_SUCCESSFULL] * 3
+        )
+        self.assertEqual(self.ltree.iterator.run, 3)
+        text = self._logfile_read(self.ljob1)
+        for arg in self.arguments:
+            self.assertTrue(self.my_arg_str_match.format(arg) in text)
+        status = simplejson.loads(self.tree.json_status())["sym"]
+        self.assertFalse("iterations" in status)
+        self.assertEqual(status["completed"], {"lawngreen": 3})
+
+    def test_treetarator_parallel_fail(self):
+        """Failed iteration fails the subtree, rerun skips successful ones"""
+        ltree = exectree.ExecTree()
+        ltree.name = "local tree"
+        ljob1 = self._newjob("sal", ltree, maxsleep=0)
+        ljob2 = self._newjob(
+            "sov", ltree, maxsleep=0,
+            append="if [ \"$2\" = asd ]; then exit 1; fi\n"
+        )
+        ltree.add_dep(ljob1, ljob2)
+        ltree.iterator = exectree.ExecIter("test", ["qwe", "asd", "zxc"], 3)
+        job4 = exectree.ExecJob("sym", subtree=ltree)
+        self.tree.add_job(job4)
+        self.tree.add_dep(self.job3, job4)
+
+        self.tree.waitsuccess = True
+        with gevent.Timeout(30):
+            self.tree.run(blocking=False)
+            job4.events[job4.STATE_FAILED].wait()
+        self.assertTrue(ljob1.is_success())
+        self.assertTrue(ljob2.is_failed())
+        self.assertEqual(ltree.iterator.finished, set([0, 2]))
+        self.assertEqual(ltree.instances.keys(), [1])
+        status = simplejson.loads(self.tree.json_status())["sym"]
+        self.assertEqual(
+            [(i["index"], i["argument"], i["status"]) for i in status["iterations"]],
+            [(1, "asd", "red")]
+        )
+        self.assertEqual(status["completed"], {"lawngreen": 2, "red": 1})
+
+        job4.reset()
+        job4.start()
+        with gevent.Timeout(30):
+            job4.events[job4.STATE_FAILED].wait()
+        self.assertEqual(ltree.instances.keys(), [1])
+
+    def test_treetarator_parallel_fail_parent(self):
+        """Iteration copies finish once a job with children fails"""
+        ltree = exectree.ExecTree()
+        ltree.name = "local tree"
+        ljob1 = self._newjob(
+            "sal", ltree, maxsleep=0,
+            append="if [ \"$2\" = asd ]; then exit 1; fi\n"
+        )
+        ljob2 = self._newjob("sov", ltree, maxsleep=0)
+        ltree.add_dep(ljob1, ljob2)
+        ltree.iterator = exectree.ExecIter("test", ["qwe", "asd", "zxc"], 2)
+        job4 = exectree.ExecJob("sym", subtree=ltree)
+        self.tree.add_job(job4)
+        self.tree.add_dep(self.job3, job4)
+
+        with gevent.Timeout(30):
+            self.tree.run(blocking=False)
+            job4.events[job4.STATE_FAILED].wait()
+        self.assertEqual(ltree.instances.keys(), [1])
+        instance = ltree.instances[1]
+        self.assertTrue(instance.find_job("sal").is_failed())
+        self.assertEqual(
+            instance.find_job("sov").state, ljob2.STATE_CANCELLED
+        )
+        self.assertTrue(ljob1.is_failed())
+        self.assertEqual(ljob2.state, ljob2.STATE_CANCELLED)
+        self.assertEqual(ltree.iterator.finished, set([0]))
+
+    def test_stream_iter(self):
+        """Arguments are read from a command as they are needed"""
+        iterator = exectree.ExecStreamIter(
+            "stream",
+            command=["sh", "-c", "echo qwe; sleep 2; echo asd, zxc"]
+        )
+        start = time.time()
+        with gevent.Timeout(10):
+            self.assertEqual(iterator.argument, "qwe")
+            self.assertTrue(time.time() - start < 1)
+            self.assertEqual(iterator.len(), 1)
+            self.assertTrue(iterator.increment())
+            self.assertEqual(iterator.argument, "asd")
+            self.assertTrue(iterator.increment())
+            self.assertFalse(iterator.increment())
+        self.assertTrue(iterator.is_exhausted())
+        self.assertEqual((iterator.run, iterator.len()), (3, 3))
+
+        path = "{0}/args".format(self.workdir)
+        with open(path, "w") as fd:
+            fd.write(",".join("a{0}".format(i) for i in range(3000)))
+        iterator = exectree.ExecStreamIter("file", path=path, parallel=2)
+        self.assertEqual(
+            [arg for index, arg in iterator.pending()],
+            ["a{0}".format(i) for i in range(3000)]
+        )
+
+    def test_arg_store(self):
+        """Iterator arguments are kept in a mapped store"""
+        args = ["c{0}".format(i) for i in range(100000)] + [u"\xe9", ""]
+        store = exectree.ExecArgStore(args)
+        self.assertEqual(len(store), len(args))
+        self.assertEqual(store[0], "c0")
+        self.assertEqual(store[99999], "c99999")
+        self.assertEqual(store[-2], u"\xe9".encode("utf-8"))
+        self.assertEqual(store[-1], "")
+        self.assertRaises(IndexError, lambda: store[len(args)])
+        self.assertEqual(list(store)[:3], args[:3])
+
+        iterator = exectree.ExecIter("test", args)
+        self.assertTrue(iterator.args is iterator.copy().args)
+        self.assertTrue(iterator.increment(1000))
+        self.assertEqual(iterator.argument, "c1000")
+        self.assertEqual(list(exectree.ExecArgStore()), [])
+        self.assertTrue(exectree.ExecIter("empty").is_exhausted())
+
+    def test_treetarator_stream(self):
+        """Run iterated subtrees over a streamed argument list"""
+        self._test_treetarator_init()
+        self.ltree.iterator = exectree.ExecStreamIter(
+            "test", command=["echo"] + self.arguments
+        )
+        with gevent.Timeout(30):
+            self.tree.run()
+        self.assertTrue(self.tree.is_success())
+        self.assertEqual(self.ltree.iterator.run, len(self.arguments))
+        text = self._logfile_read(self.ljob1)
+        for arg in self.arguments:
+            self.assertTrue(self.my_arg_str_match.format(arg) in text)
+
+    def test_treetarator_stream_fail(self):
+        """A failing stream command fails the iterated subtree"""
+        for parallel in [1, 2]:
+            self.setUp()
+            self._test_treetarator_init()
+            self.ltree.iterator = exectree.ExecStreamIter(
+                "test",
+                command=["sh", "-c", "echo qwe asd; echo broken >&2; exit 3"],
+                parallel=parallel
+            )
+            with gevent.Timeout(30):
+                self.tree.run(blocking=False)
+                self.job4.events[self.job4.STATE_FAILED].wait()
+            self.assertTrue(self.ljob1.is_success())
+            text = self._logfile_read(self.ljob1)
+            for arg in ["qwe", "asd"]:
+                self.assertTrue(self.my_arg_str_match.format(arg) in text)
+            self.assertEqual(self.ltree.iterator.error.returncode, 3)
+            self.assertEqual(self.ltree.iterator.error.output, "broken\n")
+            self.assertRaises(
+                subprocess.CalledProcessError, self.ltree.iterator.is_exhausted
+            )
+
+    def test_stream_iter_lazy(self):
+        """Streams are not read until the tree runs"""
+        self._test_treetarator_init()
+        path = "{0}/started".format(self.workdir)
+        iterator = exectree.ExecStreamIter(
+            "test", command=["sh", "-c", "touch {0}; echo qwe asd zxc".format(path)]
+        )
+        self.ltree.iterator = iterator
+        self.assertEqual(self.tree.validate(), [])
+        self.tree.prioritize()
+        self.tree.dot_graph()
+        self.tree.json_status()
+        iterator.restore(1, [])
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(iterator.argument, "asd")
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual((iterator.run, iterator.len()), (1, 2))
+
     def test_resource_validation(self):
         """Resource validation"""
         resource = exectree.ExecResource(self.tree, "test", 1)
@@ -409,6 +871,210 @@ class TestET(unittest.TestCase):
 
         self.test_xml()
 
+    def test_limit_fifo(self):
+        """Jobs waiting on a limit get slots in arrival order"""
+        limit = exectree.ExecLimit(1)
+        order = []
+
+        def worker(name):
+            limit.acquire()
+            order.append(name)
+            gevent.sleep(0.01)
+            limit.release()
+
+        gevent.joinall([gevent.spawn(worker, i) for i in range(5)])
+        self.assertEqual(order, range(5))
+        self.assertEqual(limit.used, 0)
+
+    def test_limit_priority(self):
+        """Waiting jobs with higher priority get slots first"""
+        limit = exectree.ExecLimit(1)
+        order = []
+
+        def worker(name, priority):
+            limit.acquire(priority)
+            order.append(name)
+            gevent.sleep(0.01)
+            limit.release()
+
+        gevent.joinall([
+            gevent.spawn(worker, name, priority)
+            for name, priority in [("a", 0), ("b", 1), ("c", 5), ("d", 1)]
+        ])
+        self.assertEqual(order, ["a", "c", "b", "d"])
+
+    def test_limit_resources(self):
+        """Jobs waiting for a slot leave their resources to others"""
+        limit = exectree.ExecLimit(1)
+        resource = exectree.ExecResource(self.tree, "r1", 1)
+        job4 = self._newjob("qor", self.tree, maxsleep=0, append="sleep 1\n")
+        job5 = self._newjob("qam", self.tree, maxsleep=0)
+        job6 = self._newjob("sal", self.tree, maxsleep=0)
+        for job in [job4, job5]:
+            job.limit = limit
+        for job in [job5, job6]:
+            job.resources.append(resource)
+        # job6 is ready last but only needs the resource
+        job6.priority = -1
+        for job in [job4, job5, job6]:
+            self.tree.add_dep(self.job1, job)
+        self.job1.jobpath = "/bin/true"
+        times = {}
+        for job in [job4, job5, job6]:
+            times[job] = {}
+            for state in [job.STATE_RUNNING, job.STATE_SUCCESSFULL]:
+                job.events[state].rawlink(
+                    functools.partial(self._save_event, times[job], state)
+                )
+        with gevent.Timeout(20):
+            self.tree.run()
+        self.assertTrue(self.tree.is_success())
+        self.assertTrue(
+            times[job6][job6.STATE_SUCCESSFULL]
+            < times[job4][job4.STATE_SUCCESSFULL]
+        )
+        self.assertEqual([limit.used, resource.used], [0, 0])
+
+    def test_critical_path(self):
+        """Priority is the longest path to the end of the tree"""
+        job4 = self._newjob("qux", self.tree)
+        self.tree.add_dep(self.job2, job4)
+        self.assertEqual(self.tree.prioritize(), 3)
+        self.assertEqual(
+            [job.priority for job in [self.job1, self.job2, self.job3, job4]],
+            [3, 2, 1, 1]
+        )
+
+        # Durations take over hop count, unknown ones count as the mean
+        self.job3.duration = 60
+        job4.duration = 10
+        self.assertEqual(self.tree.prioritize(), 95)
+        self.assertEqual(self.job3.priority, 60)
+        self.assertEqual(self.job2.priority, 45)
+        self.assertTrue('"priority": 95' in self.tree.json_status())
+
+    def _sample_used(self, limit, samples):
+        while True:
+            samples.append(limit.used)
+            gevent.sleep(0.01)
+
+    def test_maxparallel(self):
+        """Tree never runs more job processes than maxparallel"""
+        self.tree.maxparallel = 2
+        for i in range(6):
+            job = self._newjob("par{0}".format(i), self.tree, maxsleep=2)
+            self.tree.add_dep(self.job1, job)
+        samples = []
+        sampler = gevent.spawn(self._sample_used, self.tree.limit, samples)
+        with gevent.Timeout(30):
+            self.tree.run()
+        sampler.kill()
+        self.assertTrue(self.tree.is_success())
+        self.assertEqual(max(samples), 2)
+        self.test_xml()
+
+    def test_resource_queue(self):
+        """Resources are granted all at once without starving anyone"""
+        r1 = exectree.ExecResource(self.tree, "r1", 1)
+        r2 = exectree.ExecResource(self.tree, "r2", 1)
+        r3 = exectree.ExecResource(self.tree, "r3", 1)
+        queue = self.tree.resource_queue
+        order = []
+
+        def worker(name, units, hold):
+            queue.acquire(units)
+            order.append(name)
+            gevent.sleep(hold)
+            queue.release(units)
+
+        workers = [
+            gevent.spawn(worker, "a", {r1: 1}, 0.1),
+            gevent.spawn(worker, "b", {r1: 1, r2: 1}, 0.01),
+            # r2 is free but b was first in line for it
+            gevent.spawn(worker, "c", {r2: 1}, 0.01),
+            # r3 is wanted by nobody ahead
+            gevent.spawn(worker, "d", {r3: 1}, 0.01),
+        ]
+        gevent.joinall(workers)
+        self.assertEqual(order, ["a", "d", "b", "c"])
+        self.assertEqual([r1.used, r2.used, r3.used], [0, 0, 0])
+        self.assertTrue(r1.reserve(blocking=False))
+        self.assertFalse(r1.reserve(blocking=False))
+        r1.release()
+
+    def test_resource_unlimited(self):
+        """Waiting on a scarce resource does not hold back unlimited ones"""
+        network = exectree.ExecResource(self.tree, "network", 1)
+        cpu = exectree.ExecResource(self.tree, "cpu", 1)
+        default = exectree.ExecResource(self.tree, "default", float("inf"))
+        queue = self.tree.resource_queue
+        self.assertTrue(queue.acquire({network: 1, default: 1}, timeout=0))
+        waiter = gevent.spawn(queue.acquire, {network: 1, default: 1})
+        gevent.sleep(0.01)
+        self.assertFalse(waiter.ready())
+        self.assertTrue(queue.acquire({cpu: 1, default: 1}, timeout=0.5))
+        # network stays held for the waiter
+        self.assertFalse(queue.acquire({network: 1}, timeout=0))
+        queue.release({network: 1, default: 1})
+        with gevent.Timeout(1):
+            self.assertTrue(waiter.get())
+        queue.release({network: 1, default: 1})
+        queue.release({cpu: 1, default: 1})
+        self.assertEqual([network.used, cpu.used, default.used], [0, 0, 0])
+
+    def test_resource_units(self):
+        """Jobs claim several units of a resource"""
+        cpu = exectree.ExecResource(self.tree, "cpu", 4)
+        self.job2.resources.append(cpu)
+        self.job2.weights[cpu] = 3
+        self.job3.resources.append(cpu)
+        self.job3.weights[cpu] = 2
+        self.assertEqual(self.tree.validate(), [])
+        self.test_xml()
+
+        self.assertTrue(self.tree.resource_queue.acquire(
+            self.job2.resource_units(), timeout=0
+        ))
+        self.assertEqual(cpu.used, 3)
+        self.assertFalse(self.tree.resource_queue.acquire(
+            self.job3.resource_units(), timeout=0
+        ))
+        self.tree.resource_queue.release(self.job2.resource_units())
+        self.assertEqual(cpu.used, 0)
+
+        self.job3.weights[cpu] = 5
+        self.assertEqual(len(self.tree.validate()), 1)
+
+    def test_resource_forest(self):
+        """Jobs holding resources of a subtree and its parent wake waiters"""
+        subtree = exectree.ExecTree()
+        subtree.name = "sub"
+        local = exectree.ExecResource(subtree, "local", 1)
+        self.tree.add_job(exectree.ExecJob("qam", subtree=subtree))
+        shared = exectree.ExecResource(self.tree, "shared", 1)
+        job4 = exectree.ExecJob("qor", "/bin/true")
+        subtree.add_job(job4)
+        for name in ["local", "shared"]:
+            job4.resources.append(subtree.find_resource(name))
+        self.assertTrue(local.queue is self.tree.resource_queue)
+        self.assertTrue(shared.queue is self.tree.resource_queue)
+
+        units = job4._acquire_resources()
+        self.assertEqual([local.used, shared.used], [1, 1])
+        waiter = gevent.spawn(shared.reserve)
+        gevent.sleep(0.01)
+        self.assertFalse(waiter.ready())
+        job4._release_resources(units)
+        with gevent.Timeout(1):
+            self.assertTrue(waiter.get())
+        self.assertEqual([local.used, shared.used], [0, 1])
+        shared.release()
+
+        with gevent.Timeout(10):
+            subtree.run()
+        self.assertTrue(job4.is_success())
+        self.assertEqual([local.used, shared.used], [0, 0])
+
     def _save_event(self, times, state, event):
         times[state] = time.time()
 
@@ -455,6 +1121,113 @@ class TestET(unittest.TestCase):
                     (jr < sjr and jr < sjs)
                 )
 
+    def test_incremental(self):
+        """Jobs unchanged since they succeeded are not run again"""
+        def build():
+            tree = exectree.ExecTree()
+            tree.resultcache = cache
+            jobs = dict(
+                (job.name, exectree.ExecJob(job.name, job.jobpath, arguments=[job.name]))
+                for job in [self.job1, self.job2, self.job3]
+            )
+            for job in jobs.values():
+                tree.add_job(job)
+            tree.add_dep(jobs["foo"], jobs["bar"])
+            tree.add_dep(jobs["foo"], jobs["baz"])
+            tree.extend_args(["{0}".format(random.random())], volatile=True)
+            with gevent.Timeout(10):
+                tree.run()
+            self.assertTrue(tree.is_success())
+            return jobs
+
+        cache = ResultCache()
+        jobs = build()
+        self.assertEqual(len(cache), 3)
+        self.assertFalse(any(job.cached for job in jobs.values()))
+
+        jobs = build()
+        self.assertTrue(all(job.cached for job in jobs.values()))
+        self.assertEqual(sum(job.execcount for job in jobs.values()), 0)
+        status = simplejson.loads(jobs["foo"].tree.json_status())
+        self.assertTrue(status["foo"]["cached"])
+
+        with open(self.job1.jobpath, "a") as fd:
+            fd.write("# changed\n")
+        jobs = build()
+        self.assertFalse(any(job.cached for job in jobs.values()))
+        self.assertEqual(len(cache), 6)
+
+    def test_incremental_undef(self):
+        """Jobs behind undefined jobs are skipped until a parent changes"""
+        jpath = self._newjob("foo", maxsleep=0).jobpath
+
+        def build():
+            tree = exectree.ExecTree()
+            tree.resultcache = cache
+            job1 = exectree.ExecJob("foo", jpath)
+            undef = exectree.ExecJob("qor", exectree.ExecJob.UNDEF_JOB)
+            job2 = self._newjob("bar", tree, maxsleep=0)
+            job2.jobpath = self.job2.jobpath
+            for job in [job1, undef]:
+                tree.add_job(job)
+            tree.add_dep(job1, undef)
+            tree.add_dep(undef, job2)
+            with gevent.Timeout(10):
+                tree.run()
+            self.assertTrue(tree.is_success())
+            return job1, job2
+
+        cache = ResultCache()
+        build()
+        job1, job2 = build()
+        self.assertTrue(job1.cached and job2.cached)
+
+        with open(jpath, "a") as fd:
+            fd.write("# changed\n")
+        job1, job2 = build()
+        self.assertFalse(job1.cached or job2.cached)
+
+    def test_incremental_subtree(self):
+        """Jobs of iterated subtrees rerun when a job upstream changes"""
+        jpath = self._newjob("foo", maxsleep=0).jobpath
+        lpath = self._newjob("sal", maxsleep=0).jobpath
+
+        def build(parallel):
+            tree = exectree.ExecTree()
+            tree.resultcache = cache
+            job1 = exectree.ExecJob("foo", jpath)
+            tree.add_job(job1)
+            ltree = exectree.ExecTree()
+            ltree.name = "local tree"
+            ljob = exectree.ExecJob("sal", lpath)
+            ltree.add_job(ljob)
+            ltree.iterator = exectree.ExecIter("test", ["qwe", "asd"], parallel)
+            job4 = exectree.ExecJob("sym", subtree=ltree)
+            tree.add_job(job4)
+            tree.add_dep(job1, job4)
+            with gevent.Timeout(20):
+                tree.run()
+            self.assertTrue(tree.is_success())
+            return job1, ljob
+
+        for parallel in [1, 2]:
+            cache = ResultCache()
+            build(parallel)
+            job1, ljob = build(parallel)
+            self.assertTrue(job1.cached)
+            self.assertEqual(ljob.execcount, 0)
+            self.assertEqual(len(cache), 3)
+
+            with open(jpath, "a") as fd:
+                fd.write("# changed\n")
+            job1, ljob = build(parallel)
+            self.assertFalse(job1.cached)
+            self.assertTrue(ljob.is_success())
+            if parallel == 1:
+                self.assertEqual(ljob.execcount, 2)
+            else:
+                self.assertEqual(len(cache), 6)
+
     def test_fail_reschedule_succeed(self):
         """Reschedule failed job"""
         tfd, tpath = tempfile.mkstemp(dir=self.workdir)
@@ -0,0 +1,400 @@
+#!/usr/bin/python
+# vim: ts=4 et sts filetype=python
+# This file is part of RCubic
+#
+# Copyright (c) 2012 Wireless Generation, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from RCubic import RCubicScript
+from RCubic.RCubicScript import RCubicGroup, RCubicScriptParser
+from RCubic.RCubicUtilities import ConfigurationError, JSONCache
+import unittest
+import shutil
+import tempfile
+import os
+import subprocess
+import gevent
+import fnmatch
+from lxml import etree
+
+
+class TestParser(unittest.TestCase):
+
+    RELEASE = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "examples", "release"
+    )
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="rcs")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, False)
+
+    def _groups(self, names):
+        return [
+            RCubicGroup(etree.Element("install", group=name, version="1.0"))
+            for name in names
+        ]
+
+    def _parser(self, groups=None, **kw):
+        if groups is None:
+            groups = self._groups(sorted(os.listdir(self.RELEASE)))
+        return RCubicScriptParser(
+            groups, self.workdir, self.workdir, [], [], None, {}, **kw
+        )
+
+    def _script(self, group, name, *header, **kw):
+        """ Write executable script of group to the release in workdir,
+        running body if given """
+        groupdir = "{0}/release/{1}".format(self.workdir, group)
+        if not os.path.exists(groupdir):
+            os.makedirs(groupdir)
+        path = "{0}/{1}_{2}".format(groupdir, group, name)
+        with open(path, "w") as fd:
+            fd.write("#!/bin/bash\n")
+            for line in header:
+                fd.write("#{0}\n".format(line))
+            fd.write(kw.get("body", ""))
+            fd.write("exit 0\n")
+        os.chmod(path, 0755)
+        return path
+
+    def _scan(self, headercache=None, release=None, groups=None):
+        """ Return {name: snapshot} of the scripts of release, by default
+        examples/release """
+        parser = self._parser(groups, headercache=headercache)
+        parser.read_dirs(release or self.RELEASE)
+        return dict(
+            (script.name, script.snapshot()) for script in parser.scripts()
+        )
+
+    def test_header_cache(self):
+        """Scripts read from a warm header cache match a fresh scan"""
+        path = "{0}/headercache.json".format(self.workdir)
+        fresh = self._scan()
+        self.assertTrue(len(fresh) > 0)
+
+        cache = JSONCache(path)
+        self.assertEqual(self._scan(cache), fresh)
+        self.assertEqual((cache.hits, cache.misses), (0, len(fresh)))
+
+        cache = JSONCache(path)
+        warm = self._scan(cache)
+        self.assertEqual((cache.hits, cache.misses), (len(fresh), 0))
+        self.assertEqual(warm, fresh)
+        for script in warm.values():
+            for value in script["hdep"] + script["sdep"] + script["products"]:
+                self.assertTrue(type(value) is str)
+
+        # simplejson only hands back unicode for non ascii text
+        self._script("uni", "a.sh", "PRODUCT: caf\xc3\xa9")
+        release = "{0}/release".format(self.workdir)
+        self._scan(JSONCache(path), release, self._groups(["uni"]))
+        warm = self._scan(JSONCache(path), release, self._groups(["uni"]))
+        self.assertEqual(warm["uni_a.sh"]["products"], ["caf\xc3\xa9"])
+        self.assertTrue(type(warm["uni_a.sh"]["products"][0]) is str)
+
+    def test_serial_scan(self):
+        """Directories are scanned one at a time without thread pools"""
+        threadpool = RCubicScript.gthreadpool
+        RCubicScript.gthreadpool = None
+        try:
+            serial = self._scan()
+        finally:
+            RCubicScript.gthreadpool = threadpool
+        self.assertEqual(serial, self._scan())
+
+    def _snapshot_release(self):
+        """ Write scripts with dependencies and an iterated subtree """
+        self._script("rel", "a.sh")
+        self._script("rel", "b.sh", "HDEP: rel_a.sh", "RESOURCES: db")
+        self._script("rel", "c.sh", "HDEP: rel_b.sh", "ITER: cat args")
+        self._script("rel", "d.sh", "IDEP: rel_c.sh")
+        with open("{0}/args".format(self.workdir), "w") as fd:
+            fd.write("qwe asd\n")
+
+    def _snapshot_parser(self):
+        return RCubicScriptParser(
+            self._groups(["rel"]), self.workdir, self.workdir, [], [], None,
+            {"db": 1}
+        )
+
+    def test_snapshot(self):
+        """Trees load from a snapshot until a script changes"""
+        self._snapshot_release()
+        path = "{0}/snapshot.json".format(self.workdir)
+        parser = self._snapshot_parser()
+        parser.read_dirs("{0}/release".format(self.workdir))
+        tree = parser.init_tree(waitsuccess=True)
+        self.assertEqual(tree.validate(), [])
+        parser.save_snapshot(path, "k")
+
+        self.assertEqual(self._snapshot_parser().load_snapshot(path, "x"), None)
+        parser = self._snapshot_parser()
+        loaded = parser.load_snapshot(path, "k")
+        self.assertEqual(loaded.validate(), [])
+        self.assertEqual(
+            sorted(job.name for job in loaded.all_jobs_gen()),
+            sorted(job.name for job in tree.all_jobs_gen())
+        )
+        self.assertEqual(
+            [(dep.parent.name, dep.child.name) for dep in loaded.deps],
+            [(dep.parent.name, dep.child.name) for dep in tree.deps]
+        )
+        job = loaded.find_job("rel_b.sh")
+        self.assertEqual([r.name for r in job.resources], ["db"])
+        self.assertTrue(job is parser.tree.find_job_deep("rel_b.sh"))
+        subtree = parser.subtrees["rel_c.sh"]
+        self.assertEqual(list(subtree.iterator.args), ["qwe", "asd"])
+        self.assertEqual(
+            sorted(script.name for script in parser.scripts()),
+            ["rel_a.sh", "rel_b.sh", "rel_c.sh", "rel_d.sh"]
+        )
+
+        # Iterators are evaluated again and still validated
+        with open("{0}/args".format(self.workdir), "w") as fd:
+            fd.write("\n")
+        loaded = self._snapshot_parser().load_snapshot(path, "k")
+        self.assertEqual(
+            loaded.validate(), ["Iterator needs at least one argument to run."]
+        )
+
+        script = "{0}/release/rel/rel_a.sh".format(self.workdir)
+        mtime = os.stat(script).st_mtime
+        os.utime(script, (mtime + 10, mtime + 10))
+        self.assertEqual(self._snapshot_parser().load_snapshot(path, "k"), None)
+
+    def _iter_parser(self, itercache=None):
+        parser = RCubicScriptParser(
+            self._groups(["rel"]), self.workdir, self.workdir, [], [], None,
+            {}, githead="abc", itercache=itercache
+        )
+        parser.read_dirs("{0}/release".format(self.workdir))
+        return parser
+
+    def _iter_args(self, itercache=None):
+        parser = self._iter_parser(itercache)
+        return parser.eval_all_args(
+            [script for script in parser.scripts() if script.iterator]
+        )
+
+    def test_iter_cache(self):
+        """Cached iterator arguments match fresh ones until a script changes"""
+        self._script("rel", "a.sh", "ITER: cat args1")
+        self._script("rel", "b.sh", "ITER: cat args2")
+        script = self._script("rel", "c.sh", "ITER: cat args2", "HDEP: rel_a.sh")
+        for name, args in [("args1", "qwe asd"), ("args2", "zxc")]:
+            with open("{0}/{1}".format(self.workdir, name), "w") as fd:
+                fd.write(args)
+        path = "{0}/itercache.json".format(self.workdir)
+
+        fresh = self._iter_args()
+        self.assertEqual(fresh, {
+            "rel_a.sh": ["qwe", "asd"], "rel_b.sh": ["zxc"], "rel_c.sh": ["zxc"]
+        })
+        cache = JSONCache(path, 3600)
+        self.assertEqual(self._iter_args(cache), fresh)
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+        cache = JSONCache(path, 3600)
+        cached = self._iter_args(cache)
+        self.assertEqual((cache.hits, cache.misses), (3, 0))
+        self.assertEqual(cached, fresh)
+        for args in cached.values():
+            self.assertTrue(all(type(arg) is str for arg in args))
+
+        # Same commands, only the changed script is evaluated again
+        with open("{0}/args2".format(self.workdir), "w") as fd:
+            fd.write("poi")
+        mtime = os.stat(script).st_mtime
+        os.utime(script, (mtime + 10, mtime + 10))
+        cache = JSONCache(path, 3600)
+        self.assertEqual(self._iter_args(cache), {
+            "rel_a.sh": ["qwe", "asd"], "rel_b.sh": ["zxc"], "rel_c.sh": ["poi"]
+        })
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+        # So is everything at another commit
+        parser = self._iter_parser(JSONCache(path, 3600))
+        parser.githead = "def"
+        self.assertEqual(
+            parser.eval_all_args(parser.scripts())["rel_b.sh"], ["poi"]
+        )
+
+    def test_iter_fail(self):
+        """One failing iterator fails evaluation of all of them"""
+        self._script("rel", "a.sh", "ITER: echo qwe")
+        self._script("rel", "b.sh", "ITER: false")
+        self._script("rel", "c.sh", "ITER: echo asd")
+        try:
+            self._iter_args()
+        except subprocess.CalledProcessError, ex:
+            self.assertEqual(ex.returncode, 1)
+        else:
+            self.fail("CalledProcessError not raised")
+
+    def test_glob_match(self):
+        """Dependency globs match like fnmatch, in script order"""
+        for group, names in [("b", "12"), ("a", "1x"), ("ab", "1")]:
+            for name in names:
+                self._script(group, "{0}.sh".format(name))
+        parser = self._parser(self._groups(["b", "a", "ab"]))
+        parser.read_dirs("{0}/release".format(self.workdir))
+        parser._index_scripts()
+        names = [script.name for script in parser.scripts()]
+        self.assertEqual(
+            names, ["b_1.sh", "b_2.sh", "a_1.sh", "a_x.sh", "ab_1.sh"]
+        )
+        for dep in [
+            "*_1.sh", "*", "[ab]*", "[ab]_*", "[!a]*", "a*", "a_?.sh",
+            "a_[0-9].sh", "ab_1.sh", "b_2.sh", "c*", "[c]_1.sh"
+        ]:
+            self.assertEqual(
+                parser._glob_match(dep), fnmatch.filter(names, dep) or [dep]
+            )
+        # Unknown names are left for ExecTree to report as dangling
+        self.assertEqual(parser._glob_match("c_1.sh"), ["c_1.sh"])
+
+    def _phase_release(self, fail=None):
+        """ Write scripts of each phase logging when they start and end,
+        fail exits 1 """
+        log = "{0}/phases.log".format(self.workdir)
+        for name, header in [
+            ("e1.sh", ["PHASE: EARLY"]),
+            ("e2.sh", ["PHASE: EARLY", "HDEP: rel_e1.sh"]),
+            ("d1.sh", []),
+            ("d2.sh", ["HDEP: rel_d1.sh"]),
+            ("i.sh", ["ITER: echo qwe asd"]),
+            ("x.sh", ["IDEP: rel_i.sh", "PHASE: EARLY"]),
+            ("l1.sh", ["PHASE: LATE"]),
+            ("l2.sh", ["PHASE: LATE"]),
+        ]:
+            body = (
+                "echo \"${{0##*/}} start\" >> {0}\nsleep 0.1\n"
+                "echo \"${{0##*/}} end\" >> {0}\n"
+            ).format(log)
+            if "rel_" + name == fail:
+                body += "exit 1\n"
+            self._script("rel", name, *header, body=body)
+        parser = self._parser(self._groups(["rel"]))
+        parser.read_dirs("{0}/release".format(self.workdir))
+        return parser, log
+
+    def _phase_log(self, log):
+        """ Return {name: (start, end)} line numbers of the phase log """
+        lines = {}
+        with open(log) as fd:
+            for i, line in enumerate(fd):
+                name, event = line.split()
+                lines.setdefault(name, {})[event] = i
+        return dict(
+            (name, (events.get("start"), events.get("end")))
+            for name, events in lines.items()
+        )
+
+    def test_phases(self):
+        """Later phases start once all scripts of earlier phases succeeded"""
+        parser, log = self._phase_release()
+        tree = parser.init_tree(waitsuccess=True)
+        self.assertEqual(tree.validate(), [])
+        barriers = [job.name for job in tree.jobs if job.barrier]
+        self.assertEqual(sorted(barriers), ["PHASE_DEFAULT", "PHASE_EARLY"])
+        # One edge per script and phase it borders, not per pair of scripts
+        phased = [
+            dep for dep in tree.deps
+            if dep.parent.barrier or dep.child.barrier
+        ]
+        self.assertEqual(len(phased), 2 + 3 + 4 + 2)
+        self.assertEqual(len(tree.deps), len(phased) + 2)
+        # Scripts of iterated subtrees follow their subtree
+        self.assertEqual(tree.find_job("rel_x.sh"), None)
+        self.assertEqual(parser.subtrees["rel_i.sh"].deps, [])
+
+        with gevent.Timeout(30):
+            tree.run()
+        self.assertTrue(tree.is_success())
+        lines = self._phase_log(log)
+        # rel_i.sh is run as its subtree, rel_x.sh
+        phases = [
+            ["rel_e1.sh", "rel_e2.sh"],
+            ["rel_d1.sh", "rel_d2.sh", "rel_x.sh"],
+            ["rel_l1.sh", "rel_l2.sh"],
+        ]
+        for earlier, later in zip(phases, phases[1:]):
+            self.assertTrue(
+                max(lines[name][1] for name in earlier)
+                < min(lines[name][0] for name in later)
+            )
+
+    def test_phases_fail(self):
+        """Later phases do not start when a script of an earlier one fails"""
+        parser, log = self._phase_release(fail="rel_e2.sh")
+        tree = parser.init_tree(waitsuccess=False)
+        job = tree.find_job("rel_e2.sh")
+        with gevent.Timeout(30):
+            tree.run(blocking=False)
+            job.events[job.STATE_FAILED].wait()
+        # Give the barrier a chance to let the next phase through
+        gevent.sleep(0.5)
+        self.assertEqual(
+            sorted(self._phase_log(log)), ["rel_e1.sh", "rel_e2.sh"]
+        )
+        tree.cancel()
+
+    def _header(self, *header, **kw):
+        """ Return RCubicScript read from a script with header """
+        path = self._script("rel", "a.sh", *header, **kw)
+        return RCubicScript.RCubicScript(
+            path, "1.0", False, 0, self.workdir, [], [], None, None
+        )
+
+    def test_resources(self):
+        """Resources are listed as name or name=units"""
+        script = self._header("RESOURCES: cpu=4, network")
+        self.assertEqual(
+            script.resources, [("cpu", 4), ("network", 1), ("default", 1)]
+        )
+        script = self._header("RESOURCES: cpu = 2 db ,default=3")
+        self.assertEqual(
+            script.resources, [("cpu", 2), ("db", 1), ("default", 3)]
+        )
+        self.assertEqual(self._header().resources, [("default", 1)])
+        for resources in ["cpu=0", "cpu=x", "db, cpu=-1", "cpu="]:
+            self.assertRaises(
+                ConfigurationError,
+                self._header, "RESOURCES: {0}".format(resources)
+            )
+
+    def test_read_header(self):
+        """Header ends at the first line of code, first occurrence wins"""
+        script = self._header(
+            "HDEP: rel_b.sh", " comment", "PRODUCT: qwe", "HDEP: rel_c.sh",
+            body=(
+                "\n#SDEP: rel_d.sh\n"
+                "cat <<EOF\n#CDEP: rel_e.sh\nEOF\n#PRODUCT: asd\n"
+            )
+        )
+        self.assertEqual(script.hdep, ["rel_b.sh"])
+        self.assertEqual(script.sdep, ["rel_d.sh"])
+        self.assertEqual(script.cdep, [])
+        self.assertEqual(script.products, ["qwe"])
+
+
+if __name__ == '__main__':
+    unittest.main()